@@ -0,0 +1,329 @@
+"""
+Offline benchmark for the announcement event path.
+
+Drives on_voice_state_update with synthetic guilds, channels and members
+at a configurable event rate, using the fake TTS backend and a stub voice
+client with configurable latencies, and prints a JSON report with event
+throughput, per-stage latency percentiles, memory growth and announcement
+outcomes. No Discord connection or network access is needed.
+
+    python benchmark.py --guilds 10 --users 50 --rate 200 --duration 30
+
+Event logs written by the bot's recorder (EVENT_RECORD_ENABLED) can be
+replayed instead of the synthetic load, in real time or faster:
+
+    python benchmark.py --replay data/voice_events.jsonl.1 data/voice_events.jsonl --speed 10
+
+Bot settings such as ANNOUNCE_QUEUE_MAX or ANNOUNCE_COALESCE_WINDOW are
+read from the environment as usual.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark the voice announcer event path offline")
+    parser.add_argument('--guilds', type=int, default=5, help="number of synthetic servers")
+    parser.add_argument('--users', type=int, default=50, help="members per server")
+    parser.add_argument('--channels', type=int, default=3, help="voice channels per server")
+    parser.add_argument('--rate', type=float, default=50.0, help="voice state events per second (0 for as fast as possible)")
+    parser.add_argument('--duration', type=float, default=10.0, help="seconds to generate events for")
+    parser.add_argument('--replay', nargs='+', metavar='LOG', help="replay recorded voice event logs instead of a synthetic load")
+    parser.add_argument('--speed', type=float, default=1.0, help="replay speed multiplier (0 for as fast as possible)")
+    parser.add_argument('--tts-latency', type=float, default=0.2, help="seconds per fake TTS synthesis")
+    parser.add_argument('--connect-latency', type=float, default=0.3, help="seconds per voice connect")
+    parser.add_argument('--move-latency', type=float, default=0.1, help="seconds per voice channel move")
+    parser.add_argument('--playback', type=float, default=1.5, help="seconds each announcement plays for")
+    parser.add_argument('--drain-timeout', type=float, default=60.0, help="seconds to wait for queued announcements after the run")
+    parser.add_argument('--seed', type=int, default=1, help="random seed for the event sequence")
+    parser.add_argument('--output', help="write the JSON report to this file instead of stdout")
+    return parser.parse_args()
+
+args = parse_args()
+data_dir = tempfile.mkdtemp(prefix='voice-announcer-bench-')
+
+# Configure the bot for an offline run before importing it
+os.environ['FAKE_TTS_LATENCY'] = str(args.tts_latency)
+os.environ['DATA_DIR'] = data_dir
+os.environ['STATE_DB_PATH'] = os.path.join(data_dir, 'voice_announcer.db')
+os.environ.setdefault('DISCORD_TOKEN', 'benchmark-' + 'x' * 50)
+os.environ.setdefault('TTS_BACKEND', 'fake')
+os.environ.setdefault('ADMIN_API_ENABLED', 'False')
+os.environ.setdefault('STATE_WATCH_ENABLED', 'False')
+os.environ.setdefault('PREWARM_ENABLED', 'False')
+os.environ.setdefault('TRACE_LOG_ENABLED', 'False')
+os.environ.setdefault('TRACE_BUFFER_SIZE', '1000000')
+# Both need FFmpeg, which the stub voice client stands in for
+os.environ.setdefault('OPUS_PRECODE_ENABLED', 'False')
+os.environ.setdefault('PHRASE_COMPOSITION_ENABLED', 'False')
+
+import logging
+# Only report errors; the event recorder sets its own level and keeps working
+logging.getLogger('discord').setLevel(logging.ERROR)
+logging.getLogger('discord_bot').setLevel(logging.ERROR)
+
+import main
+
+class BenchAudioSource:
+    """Stand-in for the FFmpeg audio source; the stub voice client never reads it."""
+
+    def __init__(self, tts_file):
+        self.tts_file = tts_file
+
+class BenchVoiceClient:
+    """Voice client stub with fixed move and playback latencies."""
+
+    def __init__(self, channel):
+        self.channel = channel
+        self.latency = 0.0
+        self.connected = True
+        self.playing = False
+
+    def is_connected(self):
+        return self.connected
+
+    def is_playing(self):
+        return self.playing
+
+    def play(self, source, after=None):
+        self.playing = True
+
+        def finished():
+            self.playing = False
+            if after:
+                after(None)
+
+        asyncio.get_running_loop().call_later(args.playback, finished)
+
+    async def move_to(self, channel):
+        await asyncio.sleep(args.move_latency)
+        self.channel = channel
+
+    async def disconnect(self, force=False):
+        self.connected = False
+        self.channel.guild.voice_client = None
+
+class BenchGuild:
+    def __init__(self, guild_id):
+        self.id = guild_id
+        self.name = f"guild-{guild_id}"
+        self.shard_id = 0
+        self.voice_client = None
+        self.voice_channels = []
+        self.members = []
+
+class BenchChannel:
+    def __init__(self, channel_id, guild):
+        self.id = channel_id
+        self.name = f"channel-{channel_id}"
+        self.guild = guild
+        self.members = []
+
+    async def connect(self, timeout=10, reconnect=True):
+        await asyncio.sleep(args.connect_latency)
+        self.guild.voice_client = BenchVoiceClient(self)
+        return self.guild.voice_client
+
+class BenchMember:
+    def __init__(self, member_id, guild):
+        self.id = member_id
+        self.display_name = f"user{member_id}"
+        self.bot = False
+        self.guild = guild
+        self.channel = None
+
+class BenchVoiceState:
+    def __init__(self, channel):
+        self.channel = channel
+
+def build_world():
+    """Create the synthetic guilds, channels and members."""
+    guilds = []
+    for g in range(args.guilds):
+        guild = BenchGuild(1000 + g)
+        guild.voice_channels = [BenchChannel(guild.id * 100 + c, guild) for c in range(args.channels)]
+        guild.members = [BenchMember(guild.id * 10000 + u, guild) for u in range(args.users)]
+        guilds.append(guild)
+    return guilds
+
+def move_member(member, before, after):
+    """Update channel membership for a voice state change and return the before/after states."""
+    if before is not None and member in before.members:
+        before.members.remove(member)
+    if after is not None:
+        after.members.append(member)
+    member.channel = after
+    return member, BenchVoiceState(before), BenchVoiceState(after)
+
+def next_event(rng, guilds):
+    """Pick a member and move them: join when out of voice, otherwise mostly leave, sometimes switch channel."""
+    guild = rng.choice(guilds)
+    member = rng.choice(guild.members)
+    before = member.channel
+    if before is None or rng.random() < 0.2:
+        after = rng.choice([c for c in guild.voice_channels if c is not before])
+    else:
+        after = None
+    return move_member(member, before, after)
+
+def synthetic_events():
+    """Yield (offset, member, before, after) for the synthetic load; offset is None when unpaced."""
+    rng = random.Random(args.seed)
+    guilds = build_world()
+    start = time.monotonic()
+    count = 0
+    while True:
+        if args.rate > 0:
+            if count >= args.rate * args.duration:
+                return
+            offset = count / args.rate
+        elif time.monotonic() - start >= args.duration:
+            return
+        else:
+            offset = None
+        yield (offset,) + next_event(rng, guilds)
+        count += 1
+
+def replay_events():
+    """Yield (offset, member, before, after) for the events in the recorded logs, in time order."""
+    records = []
+    for path in args.replay:
+        with open(path, 'r') as f:
+            records.extend(json.loads(line) for line in f if line.strip())
+    records.sort(key=lambda record: record["t"])
+
+    guilds, channels, members = {}, {}, {}
+
+    def channel_for(channel_id, guild):
+        if channel_id is None:
+            return None
+        if channel_id not in channels:
+            channels[channel_id] = BenchChannel(channel_id, guild)
+            guild.voice_channels.append(channels[channel_id])
+        return channels[channel_id]
+
+    for record in records:
+        guild = guilds.get(record["g"])
+        if guild is None:
+            guild = guilds[record["g"]] = BenchGuild(record["g"])
+        member = members.get((record["g"], record["u"]))
+        if member is None:
+            member = members[(record["g"], record["u"])] = BenchMember(record["u"], guild)
+            guild.members.append(member)
+        offset = (record["t"] - records[0]["t"]) / args.speed if args.speed > 0 else None
+        yield (offset,) + move_member(member, channel_for(record["b"], guild), channel_for(record["a"], guild))
+
+def summarize(values):
+    """Return p50/p95/p99/max in milliseconds for a list of seconds."""
+    if not values:
+        return {"count": 0}
+    values = sorted(values)
+    return {
+        "count": len(values),
+        "p50": round(main.percentile(values, 0.5) * 1000, 2),
+        "p95": round(main.percentile(values, 0.95) * 1000, 2),
+        "p99": round(main.percentile(values, 0.99) * 1000, 2),
+        "max": round(values[-1] * 1000, 2)
+    }
+
+def max_rss_kb():
+    """Peak resident set size of this process in kilobytes."""
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return usage // 1024 if sys.platform == 'darwin' else usage
+
+async def drain(timeout):
+    """Wait until no leaves or bursts are pending and every playback worker has finished."""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        busy = (main.pending_leaves or main.pending_bursts
+                or any(not worker.done() for worker in main.playback_workers.values()))
+        if not busy:
+            return True
+        await asyncio.sleep(0.05)
+    return False
+
+async def run():
+    main.bot._connection.user = BenchMember(0, None)
+    main.create_audio_source = BenchAudioSource
+
+    events = replay_events() if args.replay else synthetic_events()
+    handler_times = []
+    rss_start = max_rss_kb()
+    start = time.monotonic()
+
+    count = 0
+    for offset, member, before, after in events:
+        if offset is not None:
+            delay = start + offset - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        else:
+            # Let playback workers run between events
+            await asyncio.sleep(0)
+
+        handler_start = time.perf_counter()
+        await main.on_voice_state_update(member, before, after)
+        handler_times.append(time.perf_counter() - handler_start)
+        count += 1
+
+    generation_time = time.monotonic() - start
+    drained = await drain(args.drain_timeout)
+
+    stage_durations = {}
+    event_to_audio = []
+    outcomes = {}
+    for trace in main.announcement_traces:
+        outcomes[trace.outcome] = outcomes.get(trace.outcome, 0) + 1
+        if trace.outcome != "played":
+            continue
+        for stage, duration in trace.durations().items():
+            stage_durations.setdefault(stage, []).append(duration)
+        event_to_audio.append(trace.stages["playback_started"] - min(trace.stages.values()))
+
+    return {
+        "config": vars(args),
+        "events": count,
+        "duration_s": round(generation_time, 3),
+        "events_per_sec": round(count / generation_time, 2) if generation_time else None,
+        "drained": drained,
+        "handler_latency_ms": summarize(handler_times),
+        "event_to_audio_ms": summarize(event_to_audio),
+        "stages_ms": {stage: summarize(stage_durations[stage]) for stage in main.TRACE_STAGES if stage in stage_durations},
+        "announcements": {
+            "played": main.announcement_stats["played"],
+            "dropped": main.announcement_stats["dropped"],
+            "expired": main.announcement_stats["expired"],
+            "coalesced": main.announcement_stats["coalesced"],
+            "flaps": main.announcement_stats["flaps"],
+            "rate_limited": main.announcement_stats["rate_limited"],
+            "failed": outcomes.get("failed", 0)
+        },
+        "tts": main.tts_backend.stats(),
+        "memory": {
+            "max_rss_start_kb": rss_start,
+            "max_rss_end_kb": max_rss_kb(),
+            "max_rss_growth_kb": max_rss_kb() - rss_start
+        }
+    }
+
+if __name__ == "__main__":
+    try:
+        report = asyncio.run(run())
+    finally:
+        main.tts_executor.shutdown(wait=False)
+        main.audio_executor.shutdown(wait=False)
+        shutil.rmtree(data_dir, ignore_errors=True)
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + "\n")
+    else:
+        print(output)
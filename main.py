@@ -1,13 +1,36 @@
 import os
 import asyncio
+import atexit
 import logging
+import logging.handlers
 import tempfile
 import discord
 from discord.ext import commands
 from gtts import gTTS
 from dotenv import load_dotenv
+from aiohttp import web
+from prometheus_client import Counter, Gauge, Histogram, generate_latest, CONTENT_TYPE_LATEST
 import json
+import hmac
 import os.path
+import sqlite3
+import ctypes
+import ctypes.util
+import struct
+import hashlib
+import heapq
+import itertools
+import subprocess
+import threading
+import time
+import uuid
+import wave
+from array import array
+from bisect import bisect_left
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from queue import SimpleQueue
 
 # Configure logging
 logging.basicConfig(
@@ -15,6 +38,7 @@ logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
 )
 logger = logging.getLogger('discord_bot')
+trace_logger = logging.getLogger('discord_bot.trace')
 
 # Load environment variables from .env file
 load_dotenv()
@@ -32,97 +56,1550 @@ ANNOUNCE_JOINS = os.getenv('ANNOUNCE_JOINS', 'True').lower() in ('true', 'yes',
 ANNOUNCE_LEAVES = os.getenv('ANNOUNCE_LEAVES', 'True').lower() in ('true', 'yes', '1', 't')
 WHITELIST_MODE = os.getenv('WHITELIST_MODE', 'False').lower() in ('true', 'yes', '1', 't')
 
+# Optional sharding for large numbers of servers. SHARD_COUNT is the total
+# number of shards (unset lets Discord decide) and SHARD_IDS the shards this
+# process runs, e.g. "0-3" or "4,5"; unset runs all of them.
+SHARDING_ENABLED = os.getenv('SHARDING_ENABLED', 'False').lower() in ('true', 'yes', '1', 't')
+SHARD_COUNT = int(os.getenv('SHARD_COUNT')) if os.getenv('SHARD_COUNT') else None
+
+def parse_shard_ids(value):
+    """Parse a shard list such as "0-3" or "0,2,5" into a sorted list of IDs, or None if empty."""
+    shard_ids = set()
+    for part in value.replace(' ', '').split(','):
+        if not part:
+            continue
+        if '-' in part:
+            first, last = part.split('-', 1)
+            shard_ids.update(range(int(first), int(last) + 1))
+        else:
+            shard_ids.add(int(part))
+    return sorted(shard_ids) or None
+
+try:
+    SHARD_IDS = parse_shard_ids(os.getenv('SHARD_IDS', ''))
+except ValueError:
+    logger.error(f"Invalid SHARD_IDS '{os.getenv('SHARD_IDS')}'. Use a list or range such as 0,1 or 0-3.")
+    exit(1)
+if SHARDING_ENABLED and SHARD_IDS and (SHARD_COUNT is None or SHARD_IDS[-1] >= SHARD_COUNT):
+    logger.error("SHARD_IDS requires SHARD_COUNT to be set and larger than every shard ID.")
+    exit(1)
+# Distinguishes files written by processes running different shards
+SHARD_SUFFIX = f"-shard{SHARD_IDS[0]}-{SHARD_IDS[-1]}" if SHARDING_ENABLED and SHARD_IDS else ""
+
+# Local admin API used by the web interface to change settings without a restart
+ADMIN_API_ENABLED = os.getenv('ADMIN_API_ENABLED', 'True').lower() in ('true', 'yes', '1', 't')
+ADMIN_API_HOST = os.getenv('ADMIN_API_HOST', '0.0.0.0')
+ADMIN_API_PORT = int(os.getenv('ADMIN_API_PORT', '8080'))
+ADMIN_API_TOKEN = os.getenv('ADMIN_API_TOKEN', '')
+
+# Persistent data directory (mounted as a volume in Docker)
+DATA_DIR = os.getenv('DATA_DIR', 'data')
+
+# TTS audio cache configuration
+TTS_CACHE_ENABLED = os.getenv('TTS_CACHE_ENABLED', 'True').lower() in ('true', 'yes', '1', 't')
+# Each shard process keeps its own cache; the cache cleans up and evicts files
+# assuming no other process uses its directory
+TTS_CACHE_DIR = os.getenv('TTS_CACHE_DIR', os.path.join(DATA_DIR, f'tts_cache{SHARD_SUFFIX}'))
+TTS_CACHE_MAX_MB = float(os.getenv('TTS_CACHE_MAX_MB', '100'))
+TTS_CACHE_MAX_AGE_DAYS = float(os.getenv('TTS_CACHE_MAX_AGE_DAYS', '30'))
+
+# TTS backend: gtts (Google, needs network), espeak (local espeak-ng) or fake (testing)
+TTS_BACKEND = os.getenv('TTS_BACKEND', 'gtts').lower()
+FAKE_TTS_LATENCY = float(os.getenv('FAKE_TTS_LATENCY', '0'))
+# Start playing uncached announcements while they are still being synthesized
+TTS_STREAMING_ENABLED = os.getenv('TTS_STREAMING_ENABLED', 'True').lower() in ('true', 'yes', '1', 't')
+
+# TTS worker pool configuration
+TTS_MAX_WORKERS = int(os.getenv('TTS_MAX_WORKERS', '2'))
+TTS_TIMEOUT = float(os.getenv('TTS_TIMEOUT', '10'))
+# Fair sharing of the TTS workers between servers: how many jobs one server
+# may run at once while other servers have jobs waiting (by default one worker
+# is left for them) and optional weights as "guild_id:weight,..."
+TTS_GUILD_CONCURRENCY = int(os.getenv('TTS_GUILD_CONCURRENCY', str(max(1, TTS_MAX_WORKERS - 1))))
+TTS_GUILD_WEIGHTS = {
+    int(guild_id): float(weight)
+    for guild_id, weight in (entry.split(':', 1) for entry in os.getenv('TTS_GUILD_WEIGHTS', '').replace(' ', '').split(',') if entry)
+}
+
+# Announcement queue configuration
+ANNOUNCE_QUEUE_MAX = int(os.getenv('ANNOUNCE_QUEUE_MAX', '10'))
+ANNOUNCE_MAX_AGE = float(os.getenv('ANNOUNCE_MAX_AGE', '15'))
+ANNOUNCE_COALESCE_WINDOW = float(os.getenv('ANNOUNCE_COALESCE_WINDOW', '1.0'))
+
+# Flap damping: leave announcements are held this many seconds and cancelled,
+# together with the rejoin, if the member comes back in time (0 disables)
+FLAP_HOLD_DOWN = float(os.getenv('FLAP_HOLD_DOWN', '2'))
+# Maximum announcements per member per minute; more are suppressed (0 disables)
+USER_ANNOUNCE_RATE_LIMIT = int(os.getenv('USER_ANNOUNCE_RATE_LIMIT', '6'))
+
+# Seconds to keep a voice connection open after the last announcement
+VOICE_IDLE_TIMEOUT = float(os.getenv('VOICE_IDLE_TIMEOUT', '300'))
+
+# Pre-encoded Opus playback configuration
+OPUS_PRECODE_ENABLED = os.getenv('OPUS_PRECODE_ENABLED', 'True').lower() in ('true', 'yes', '1', 't')
+OPUS_MEMORY_CACHE_MB = float(os.getenv('OPUS_MEMORY_CACHE_MB', '16'))
+
+# Build default announcements from cached name and suffix clips
+PHRASE_COMPOSITION_ENABLED = os.getenv('PHRASE_COMPOSITION_ENABLED', 'True').lower() in ('true', 'yes', '1', 't')
+PHRASE_CROSSFADE_MS = float(os.getenv('PHRASE_CROSSFADE_MS', '30'))
+PHRASE_SILENCE_THRESHOLD = 500
+
+# Startup pre-warming of announcement audio
+PREWARM_ENABLED = os.getenv('PREWARM_ENABLED', 'True').lower() in ('true', 'yes', '1', 't')
+PREWARM_RATE = float(os.getenv('PREWARM_RATE', '1.0'))
+
+# Per-announcement stage tracing
+TRACE_BUFFER_SIZE = int(os.getenv('TRACE_BUFFER_SIZE', '500'))
+TRACE_LOG_ENABLED = os.getenv('TRACE_LOG_ENABLED', 'True').lower() in ('true', 'yes', '1', 't')
+
+# Opt-in recording of anonymized voice state events for replay with benchmark.py
+EVENT_RECORD_ENABLED = os.getenv('EVENT_RECORD_ENABLED', 'False').lower() in ('true', 'yes', '1', 't')
+EVENT_RECORD_PATH = os.getenv('EVENT_RECORD_PATH', os.path.join(DATA_DIR, f'voice_events{SHARD_SUFFIX}.jsonl'))
+EVENT_RECORD_MAX_MB = float(os.getenv('EVENT_RECORD_MAX_MB', '10'))
+EVENT_RECORD_BACKUPS = int(os.getenv('EVENT_RECORD_BACKUPS', '3'))
+
+# Prometheus metrics for the announcement pipeline, served on the admin API at /metrics
+EVENT_TO_AUDIO_SECONDS = Histogram(
+    'voice_announcer_event_to_audio_seconds', 'Time from voice state event to the start of playback',
+    buckets=(0.1, 0.25, 0.5, 1, 1.5, 2, 3, 5, 8, 13, 20)
+)
+TTS_SYNTHESIS_SECONDS = Histogram(
+    'voice_announcer_tts_synthesis_seconds', 'Time spent synthesizing announcement audio', ['backend'],
+    buckets=(0.05, 0.1, 0.25, 0.5, 1, 2, 4, 8, 15)
+)
+VOICE_CONNECT_SECONDS = Histogram(
+    'voice_announcer_voice_connect_seconds', 'Time spent connecting to or moving between voice channels', ['kind'],
+    buckets=(0.05, 0.1, 0.25, 0.5, 1, 2, 4, 10)
+)
+PLAYBACK_SECONDS = Histogram(
+    'voice_announcer_playback_seconds', 'Duration of announcement playback',
+    buckets=(0.5, 1, 1.5, 2, 3, 5, 8, 13)
+)
+VOICE_EVENTS = Counter('voice_announcer_voice_events_total', 'Voice state events received')
+ANNOUNCEMENTS_PLAYED = Counter('voice_announcer_announcements_total', 'Announcements played')
+ANNOUNCEMENTS_DROPPED = Counter('voice_announcer_announcements_dropped_total', 'Announcements not played', ['reason'])
+ANNOUNCEMENTS_SUPPRESSED = Counter('voice_announcer_announcements_suppressed_total', 'Announcements suppressed by flap damping or rate limiting', ['reason'])
+ANNOUNCEMENTS_COALESCED = Counter('voice_announcer_announcements_coalesced_total', 'Events merged into another announcement')
+TTS_CACHE_HITS = Counter('voice_announcer_tts_cache_hits_total', 'TTS cache hits')
+TTS_CACHE_MISSES = Counter('voice_announcer_tts_cache_misses_total', 'TTS cache misses')
+ERRORS = Counter('voice_announcer_errors_total', 'Errors in the announcement pipeline', ['stage'])
+QUEUE_DEPTH = Gauge('voice_announcer_queue_depth', 'Announcements waiting to be played', ['guild'])
+PRESENCE_INIT_SECONDS = Histogram(
+    'voice_announcer_presence_init_seconds', 'Time spent building the voice presence of one server',
+    buckets=(0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5)
+)
+TTS_QUEUE_WAIT_SECONDS = Histogram(
+    'voice_announcer_tts_queue_wait_seconds', 'Time TTS jobs wait for a worker', ['priority'],
+    buckets=(0.001, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10)
+)
+TTS_QUEUED_JOBS = Gauge('voice_announcer_tts_queued_jobs', 'TTS jobs waiting for a worker')
+STARTUP_READY_SECONDS = Gauge('voice_announcer_startup_ready_seconds', 'Time from process start to the first ready event')
+ACTIVE_VOICE_CONNECTIONS = Gauge('voice_announcer_active_voice_connections', 'Connected voice clients')
+
 # Bot configuration
 intents = discord.Intents.default()
 intents.voice_states = True  # Enable voice state updates
 intents.message_content = True  # Enable message content
 
-bot = commands.Bot(command_prefix=COMMAND_PREFIX, intents=intents)
+if SHARDING_ENABLED:
+    bot = commands.AutoShardedBot(command_prefix=COMMAND_PREFIX, intents=intents,
+                                  shard_count=SHARD_COUNT, shard_ids=SHARD_IDS)
+else:
+    bot = commands.Bot(command_prefix=COMMAND_PREFIX, intents=intents)
 
 # Track voice connections to prevent multiple announcements
 active_voice_clients = {}
-# Track users in voice channels to avoid announcing if they're already there
-users_in_voice = {}
+ACTIVE_VOICE_CONNECTIONS.set_function(lambda: sum(1 for client in active_voice_clients.values() if client.is_connected()))
+process_started = time.monotonic()
+bot_ready_once = False
+# Per-guild announcement queues and the workers that play them
+announcement_queues = {}
+playback_workers = {}
+# Timers that close voice connections after they have been idle
+idle_disconnect_tasks = {}
+# Per-guild voice connection health counters
+voice_health = {}
+# Per-shard gateway health and event counters
+shard_health = {}
+# Background pre-warming of announcement audio
+prewarm_task = None
+prewarm_state = {"total": 0, "done": 0, "synthesized": 0, "failed": 0, "started": None, "finished": None}
+announcement_stats = {"played": 0, "dropped": 0, "expired": 0, "coalesced": 0, "flaps": 0, "rate_limited": 0}
+# Leave announcements held for flap damping, keyed by (guild ID, member ID)
+pending_leaves = {}
+# Recent announcement times per (guild ID, member ID) for rate limiting
+user_announcement_times = {}
+user_announcement_sweep = 0.0
+# Default announcements being collected per (channel, action) during a burst
+pending_bursts = {}
+# Traces of recently finished announcements, newest last
+announcement_traces = deque(maxlen=TRACE_BUFFER_SIZE)
 
 # Custom announcement messages
 custom_announcements = {"users": {}}
-CUSTOM_ANNOUNCEMENTS_FILE = "custom_announcements.json"
+CUSTOM_ANNOUNCEMENTS_FILE = "custom_announcements.json"  # Legacy, imported into the state database
 
 # User whitelist for announcements
 announcement_whitelist = set()
-WHITELIST_FILE = "announcement_whitelist.json"
+WHITELIST_FILE = "announcement_whitelist.json"  # Legacy, imported into the state database
+
+# SQLite database holding custom announcements and the whitelist
+STATE_DB_PATH = os.getenv('STATE_DB_PATH', os.path.join(DATA_DIR, 'voice_announcer.db'))
+STATE_WATCH_ENABLED = os.getenv('STATE_WATCH_ENABLED', 'True').lower() in ('true', 'yes', '1', 't')
+STATE_POLL_INTERVAL = float(os.getenv('STATE_POLL_INTERVAL', '2'))
+state_watcher_started = False
+state_reload_handle = None
+state_poll_tasks = []
+admin_api_runner = None
 
-# Load whitelist if file exists
+# Index of member ID -> custom messages and whitelist status, so per-event
+# lookups do not depend on the number of members
+announcement_profiles = {}
+DEFAULT_ANNOUNCEMENT_PROFILE = {"join_message": None, "leave_message": None, "whitelisted": False}
+
+# Shared SQLite state store (also used by web/app.py; keep the schema in sync)
+STATE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS custom_announcements (
+    user_id TEXT PRIMARY KEY,
+    display_name TEXT,
+    join_message TEXT,
+    leave_message TEXT,
+    updated_at REAL
+);
+CREATE TABLE IF NOT EXISTS whitelist (
+    user_id TEXT PRIMARY KEY,
+    added_at REAL
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+CREATE TABLE IF NOT EXISTS settings (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+def open_state_db():
+    """Open a connection to the state database in WAL mode, creating the schema if needed."""
+    os.makedirs(os.path.dirname(os.path.abspath(STATE_DB_PATH)), exist_ok=True)
+    conn = sqlite3.connect(STATE_DB_PATH, timeout=10, check_same_thread=False)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.executescript(STATE_SCHEMA)
+    return conn
+
+def import_legacy_json(conn):
+    """
+    One-time import of custom_announcements.json and announcement_whitelist.json
+    into the state database. Existing rows are never overwritten.
+    """
+    if conn.execute("SELECT 1 FROM meta WHERE key = 'json_imported'").fetchone():
+        return
+    
+    now = time.time()
+    with conn:
+        for path in (CUSTOM_ANNOUNCEMENTS_FILE, os.path.join(DATA_DIR, CUSTOM_ANNOUNCEMENTS_FILE)):
+            if not os.path.exists(path):
+                continue
+            try:
+                with open(path, 'r') as f:
+                    data = json.load(f)
+                users = data.get("users", {}) if isinstance(data, dict) else {}
+                rows = [(user_id, entry.get("display_name"), entry.get("join_message"), entry.get("leave_message"), now)
+                        for user_id, entry in users.items() if user_id != "_comment" and isinstance(entry, dict)]
+                conn.executemany("INSERT OR IGNORE INTO custom_announcements VALUES (?, ?, ?, ?, ?)", rows)
+                logger.info(f"Imported {len(rows)} custom announcements from {path}")
+            except Exception as e:
+                logger.error(f"Error importing custom announcements from {path}: {e}")
+        
+        for path in (WHITELIST_FILE, os.path.join(DATA_DIR, WHITELIST_FILE)):
+            if not os.path.exists(path):
+                continue
+            try:
+                with open(path, 'r') as f:
+                    data = json.load(f)
+                users = data.get("users", []) if isinstance(data, dict) else []
+                conn.executemany("INSERT OR IGNORE INTO whitelist VALUES (?, ?)", [(str(user_id), now) for user_id in users])
+                logger.info(f"Imported {len(users)} whitelisted users from {path}")
+            except Exception as e:
+                logger.error(f"Error importing whitelist from {path}: {e}")
+        
+        conn.execute("INSERT OR REPLACE INTO meta VALUES ('json_imported', ?)", (str(now),))
+
+# Load whitelist from the state database
 def load_whitelist():
     global announcement_whitelist
     try:
-        if os.path.exists(WHITELIST_FILE):
-            with open(WHITELIST_FILE, 'r') as f:
-                data = json.load(f)
-                if isinstance(data, dict) and "users" in data:
-                    announcement_whitelist = set(data["users"])
-                    logger.info(f"Loaded {len(announcement_whitelist)} users in announcement whitelist")
-                else:
-                    logger.warning(f"Invalid format in {WHITELIST_FILE}, using default empty whitelist")
-        else:
-            logger.info(f"No {WHITELIST_FILE} found, using default empty whitelist")
+        announcement_whitelist = {row["user_id"] for row in state_db.execute("SELECT user_id FROM whitelist")}
+        logger.info(f"Loaded {len(announcement_whitelist)} users in announcement whitelist")
     except Exception as e:
         logger.error(f"Error loading whitelist: {e}")
 
-# Save whitelist to file
-def save_whitelist():
+# Add or remove a single whitelisted user in the state database
+def save_whitelist_user(user_id):
     try:
-        with open(WHITELIST_FILE, 'w') as f:
-            json.dump({"users": list(announcement_whitelist)}, f, indent=4)
-        logger.info(f"Saved {len(announcement_whitelist)} users to announcement whitelist")
+        with state_db:
+            if user_id in announcement_whitelist:
+                state_db.execute("INSERT OR IGNORE INTO whitelist VALUES (?, ?)", (user_id, time.time()))
+            else:
+                state_db.execute("DELETE FROM whitelist WHERE user_id = ?", (user_id,))
+        logger.info(f"Saved whitelist entry for user {user_id}")
     except Exception as e:
         logger.error(f"Error saving whitelist: {e}")
 
-# Load custom announcements if file exists
+# Load custom announcements from the state database
 def load_custom_announcements():
     global custom_announcements
     try:
-        if os.path.exists(CUSTOM_ANNOUNCEMENTS_FILE):
-            with open(CUSTOM_ANNOUNCEMENTS_FILE, 'r') as f:
-                loaded_data = json.load(f)
-                if isinstance(loaded_data, dict) and "users" in loaded_data:
-                    custom_announcements = loaded_data
-                    logger.info(f"Loaded {len(custom_announcements['users']) - (1 if '_comment' in custom_announcements['users'] else 0)} custom announcements")
-                else:
-                    logger.warning(f"Invalid format in {CUSTOM_ANNOUNCEMENTS_FILE}, using default")
-        else:
-            logger.info(f"No {CUSTOM_ANNOUNCEMENTS_FILE} found, using default")
+        users = {}
+        for row in state_db.execute("SELECT * FROM custom_announcements"):
+            entry = {"display_name": row["display_name"] or "Unknown User"}
+            if row["join_message"]:
+                entry["join_message"] = row["join_message"]
+            if row["leave_message"]:
+                entry["leave_message"] = row["leave_message"]
+            users[row["user_id"]] = entry
+        custom_announcements = {"users": users}
+        logger.info(f"Loaded {len(users)} custom announcements")
     except Exception as e:
         logger.error(f"Error loading custom announcements: {e}")
 
-# Save custom announcements to file
-def save_custom_announcements():
+# Upsert or delete a single user's custom announcements in the state database
+def save_custom_announcement(user_id):
     try:
-        with open(CUSTOM_ANNOUNCEMENTS_FILE, 'w') as f:
-            json.dump(custom_announcements, f, indent=4)
-        logger.info(f"Saved {len(custom_announcements['users']) - (1 if '_comment' in custom_announcements['users'] else 0)} custom announcements")
+        entry = custom_announcements["users"].get(user_id)
+        with state_db:
+            if entry:
+                state_db.execute(
+                    """INSERT INTO custom_announcements VALUES (?, ?, ?, ?, ?)
+                       ON CONFLICT(user_id) DO UPDATE SET display_name = excluded.display_name,
+                           join_message = excluded.join_message, leave_message = excluded.leave_message,
+                           updated_at = excluded.updated_at""",
+                    (user_id, entry.get("display_name"), entry.get("join_message"), entry.get("leave_message"), time.time())
+                )
+            else:
+                state_db.execute("DELETE FROM custom_announcements WHERE user_id = ?", (user_id,))
+        logger.info(f"Saved custom announcements for user {user_id}")
     except Exception as e:
         logger.error(f"Error saving custom announcements: {e}")
 
+# Settings that can be changed while the bot is running
+RUNTIME_SETTINGS = ('VOICE_LANGUAGE', 'COMMAND_PREFIX', 'ANNOUNCE_JOINS', 'ANNOUNCE_LEAVES', 'WHITELIST_MODE')
+BOOLEAN_SETTINGS = ('ANNOUNCE_JOINS', 'ANNOUNCE_LEAVES', 'WHITELIST_MODE')
+
+def get_runtime_settings():
+    """Return the current values of the runtime settings."""
+    return {key: globals()[key] for key in RUNTIME_SETTINGS}
+
+def apply_runtime_settings(settings):
+    """
+    Validate and apply runtime settings. Raises ValueError for unknown keys
+    or invalid values; nothing is applied in that case. Returns the keys that changed.
+    """
+    global VOICE_LANGUAGE, COMMAND_PREFIX, ANNOUNCE_JOINS, ANNOUNCE_LEAVES, WHITELIST_MODE
+    parsed = {}
+    for key, value in settings.items():
+        if key not in RUNTIME_SETTINGS:
+            raise ValueError(f"{key} cannot be changed at runtime")
+        if key in BOOLEAN_SETTINGS:
+            parsed[key] = value if isinstance(value, bool) else str(value).lower() in ('true', 'yes', '1', 't')
+        else:
+            value = str(value).strip()
+            if not value:
+                raise ValueError(f"{key} cannot be empty")
+            parsed[key] = value
+    
+    changed = [key for key, value in parsed.items() if globals()[key] != value]
+    VOICE_LANGUAGE = parsed.get('VOICE_LANGUAGE', VOICE_LANGUAGE)
+    COMMAND_PREFIX = parsed.get('COMMAND_PREFIX', COMMAND_PREFIX)
+    ANNOUNCE_JOINS = parsed.get('ANNOUNCE_JOINS', ANNOUNCE_JOINS)
+    ANNOUNCE_LEAVES = parsed.get('ANNOUNCE_LEAVES', ANNOUNCE_LEAVES)
+    WHITELIST_MODE = parsed.get('WHITELIST_MODE', WHITELIST_MODE)
+    bot.command_prefix = COMMAND_PREFIX
+    return changed
+
+def load_runtime_settings():
+    """
+    Apply settings saved through the admin API or bot commands. A saved
+    setting overrides its environment variable until that variable changes
+    (e.g. in the compose file or Unraid template), which clears the override.
+    """
+    try:
+        # Environment values are compared with those seen on the previous start
+        environment = {key: str(globals()[key]) for key in RUNTIME_SETTINGS}
+        row = state_db.execute("SELECT value FROM meta WHERE key = 'settings_environment'").fetchone()
+        previous = json.loads(row["value"]) if row else environment
+        changed = [key for key in RUNTIME_SETTINGS if previous.get(key, environment[key]) != environment[key]]
+        with state_db:
+            if changed:
+                state_db.executemany("DELETE FROM settings WHERE key = ?", [(key,) for key in changed])
+                logger.info(f"Environment changed, cleared saved settings: {', '.join(changed)}")
+            state_db.execute("INSERT OR REPLACE INTO meta VALUES ('settings_environment', ?)", (json.dumps(environment),))
+        
+        saved = {row["key"]: row["value"] for row in state_db.execute("SELECT key, value FROM settings")}
+        saved = {key: value for key, value in saved.items() if key in RUNTIME_SETTINGS}
+        if saved:
+            apply_runtime_settings(saved)
+            logger.info(f"Applied saved settings: {', '.join(sorted(saved))}")
+    except Exception as e:
+        logger.error(f"Error loading saved settings: {e}")
+
+def save_runtime_settings(keys):
+    """Persist runtime settings so they survive a restart."""
+    try:
+        with state_db:
+            state_db.executemany(
+                "INSERT OR REPLACE INTO settings VALUES (?, ?)",
+                [(key, str(globals()[key])) for key in keys]
+            )
+    except Exception as e:
+        logger.error(f"Error saving settings: {e}")
+
+def update_announcement_profile(user_id):
+    """Refresh the announcement profile of a single user from the loaded data."""
+    custom = custom_announcements["users"].get(user_id)
+    if not isinstance(custom, dict):
+        custom = {}
+    profile = {
+        "join_message": custom.get("join_message"),
+        "leave_message": custom.get("leave_message"),
+        "whitelisted": user_id in announcement_whitelist
+    }
+    if profile["join_message"] or profile["leave_message"] or profile["whitelisted"]:
+        announcement_profiles[user_id] = profile
+    else:
+        announcement_profiles.pop(user_id, None)
+
+def rebuild_announcement_profiles():
+    """Rebuild the member ID -> announcement profile index from scratch."""
+    announcement_profiles.clear()
+    for user_id in set(custom_announcements["users"]) | announcement_whitelist:
+        if user_id != "_comment":
+            update_announcement_profile(user_id)
+
+def candidate_usernames(user_id):
+    """Names a user may be announced under: their stored display name and their names in each guild."""
+    names = set()
+    entry = custom_announcements["users"].get(user_id)
+    if isinstance(entry, dict) and entry.get("display_name"):
+        names.add(entry["display_name"])
+    for guild in bot.guilds:
+        member = guild.get_member(int(user_id))
+        if member:
+            names.add(member.display_name)
+    return names
+
+def apply_announcement_change(user_id):
+    """
+    Refresh a user's announcement profile after their custom messages or
+    whitelist status changed, and drop cached audio for messages that were
+    replaced or removed.
+    """
+    old_profile = get_announcement_profile(user_id)
+    update_announcement_profile(user_id)
+    new_profile = get_announcement_profile(user_id)
+    if not TTS_CACHE_ENABLED:
+        return
+    
+    for message_key in ("join_message", "leave_message"):
+        old_message = old_profile[message_key]
+        if not old_message or old_message == new_profile[message_key]:
+            continue
+        for username in candidate_usernames(user_id):
+            try:
+                text = old_message.format(username=username)
+            except (KeyError, IndexError, ValueError):
+                continue
+            tts_cache.invalidate(TTSCache.make_key(text, VOICE_LANGUAGE, TTS_BACKEND))
+
+def get_announcement_profile(user_id):
+    """Return the announcement profile for a member ID (int or str)."""
+    return announcement_profiles.get(str(user_id), DEFAULT_ANNOUNCEMENT_PROFILE)
+
+class GuildPresence:
+    """
+    Voice members of one guild as two parallel arrays, member IDs in sorted
+    order and the channel ID of each, so each tracked member costs 16 bytes.
+    """
+    __slots__ = ('member_ids', 'channel_ids')
+
+    def __init__(self):
+        self.member_ids = array('Q')
+        self.channel_ids = array('Q')
+
+    def find(self, member_id):
+        """Return (position, found) for a member ID in the sorted arrays."""
+        position = bisect_left(self.member_ids, member_id)
+        return position, position < len(self.member_ids) and self.member_ids[position] == member_id
+
+class VoicePresence:
+    """
+    Tracks which voice channel each member is in, per guild. Lookups and
+    moves are a binary search; joins and leaves also shift the tail of the
+    guild's arrays, a memmove that stays in the microseconds for tens of
+    thousands of members.
+    """
+
+    def __init__(self):
+        self.guilds = {}  # guild ID -> GuildPresence
+
+    def has_guild(self, guild_id):
+        return guild_id in self.guilds
+
+    def add_guild(self, guild_id, members=()):
+        """Start tracking a guild from (member ID, channel ID) pairs, replacing any previous state."""
+        channels = dict(members)
+        guild = self.guilds[guild_id] = GuildPresence()
+        for member_id in sorted(channels):
+            guild.member_ids.append(member_id)
+            guild.channel_ids.append(channels[member_id])
+        return guild
+
+    def remove_guild(self, guild_id):
+        self.guilds.pop(guild_id, None)
+
+    def channel_of(self, guild_id, member_id):
+        """Return the ID of the channel a member is in, or None."""
+        guild = self.guilds.get(guild_id)
+        if guild is None:
+            return None
+        position, found = guild.find(member_id)
+        return guild.channel_ids[position] if found else None
+
+    def join(self, guild_id, member_id, channel_id):
+        """Record a member in a channel, moving them if they were elsewhere. Returns the previous channel ID or None."""
+        guild = self.guilds.get(guild_id) or self.add_guild(guild_id)
+        position, found = guild.find(member_id)
+        if found:
+            previous = guild.channel_ids[position]
+            guild.channel_ids[position] = channel_id
+            return previous
+        guild.member_ids.insert(position, member_id)
+        guild.channel_ids.insert(position, channel_id)
+        return None
+
+    move = join
+
+    def leave(self, guild_id, member_id):
+        """Forget a member. Returns the ID of the channel they were in, or None if they were not tracked."""
+        guild = self.guilds.get(guild_id)
+        if guild is None:
+            return None
+        position, found = guild.find(member_id)
+        if not found:
+            return None
+        channel_id = guild.channel_ids[position]
+        del guild.member_ids[position]
+        del guild.channel_ids[position]
+        return channel_id
+
+    def members(self, guild_id, channel_id):
+        """Return the IDs of the members in a channel. Scans the guild; not meant for hot paths."""
+        guild = self.guilds.get(guild_id)
+        if guild is None:
+            return []
+        return [member_id for member_id, member_channel in zip(guild.member_ids, guild.channel_ids)
+                if member_channel == channel_id]
+
+    def count(self):
+        """Return the number of tracked members across all guilds."""
+        return sum(len(guild.member_ids) for guild in self.guilds.values())
+
+    def snapshot(self):
+        """Return the tracked state as {guild ID: [[member ID, channel ID], ...]}, suitable for JSON."""
+        return {guild_id: [list(pair) for pair in zip(guild.member_ids, guild.channel_ids)]
+                for guild_id, guild in self.guilds.items()}
+
+    def restore(self, snapshot):
+        """Replace the tracked state with a snapshot. Keys may be strings, as after a JSON round trip."""
+        self.guilds = {}
+        for guild_id, members in snapshot.items():
+            self.add_guild(int(guild_id), ((int(member_id), int(channel_id)) for member_id, channel_id in members))
+
+# Track which channel each member is in to avoid announcing if they're already
+# there. Filled per guild as it becomes available or on its first voice event.
+voice_presence = VoicePresence()
+
+def opus_sidecar_path(path):
+    """Return the path of the pre-encoded Opus frames stored next to a cached clip."""
+    return os.path.splitext(path)[0] + '.opus'
+
+class TTSCache:
+    """
+    Content-addressed on-disk cache of synthesized announcement audio.
+    Files are keyed by a hash of (text, language, backend) and tracked in an
+    in-memory LRU index; entries are evicted when the cache exceeds its size
+    limit or when they are older than the age limit.
+    """
+
+    def __init__(self, directory, max_bytes, max_age_seconds):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_age_seconds = max_age_seconds
+        self.index = OrderedDict()  # key -> (path, size including the Opus sidecar, created)
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def make_key(text, language, backend):
+        """Build the cache key for a piece of announcement text."""
+        return hashlib.sha256(f"{backend}\0{language}\0{text}".encode('utf-8')).hexdigest()
+
+    def path_for(self, key):
+        """Return the on-disk path for a cache key."""
+        return os.path.join(self.directory, f"{key}.mp3")
+
+    def load(self):
+        """Create the cache directory and rebuild the index from the files on disk."""
+        os.makedirs(self.directory, exist_ok=True)
+        entries = []
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if not name.endswith('.mp3'):
+                # Leftover partial write from an interrupted synthesis
+                if name.endswith('.tmp') or (name.endswith('.opus') and not os.path.exists(path[:-5] + '.mp3')):
+                    try:
+                        os.unlink(path)
+                    except OSError:
+                        pass
+                continue
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            size = stat.st_size
+            sidecar = opus_sidecar_path(path)
+            try:
+                sidecar_stat = os.stat(sidecar)
+                if sidecar_stat.st_mtime >= stat.st_mtime:
+                    size += sidecar_stat.st_size
+                else:
+                    # Encoded from an older version of the clip
+                    os.unlink(sidecar)
+            except OSError:
+                pass
+            entries.append((stat.st_atime, name[:-4], path, size, stat.st_mtime))
+        # Least recently used entries first
+        entries.sort()
+        with self.lock:
+            self.index.clear()
+            self.total_bytes = 0
+            for _, key, path, size, created in entries:
+                self.index[key] = (path, size, created)
+                self.total_bytes += size
+        self.evict()
+        logger.info(f"Loaded {len(self.index)} cached TTS clips ({self.total_bytes / 1048576:.1f} MB)")
+
+    def get(self, key):
+        """Return the cached file path for a key, or None on a miss."""
+        with self.lock:
+            entry = self.index.get(key)
+            if entry is not None:
+                path, size, created = entry
+                if time.time() - created > self.max_age_seconds or not os.path.exists(path):
+                    self._remove(key)
+                    entry = None
+                else:
+                    self.index.move_to_end(key)
+            if entry is None:
+                self.misses += 1
+                TTS_CACHE_MISSES.inc()
+                return None
+            self.hits += 1
+            TTS_CACHE_HITS.inc()
+            return entry[0]
+
+    def put(self, key, temp_path):
+        """Move a freshly synthesized file into the cache and return its final path."""
+        path = self.path_for(key)
+        os.replace(temp_path, path)
+        size = os.path.getsize(path)
+        # A sidecar encoded from the previous clip is stale
+        try:
+            os.unlink(opus_sidecar_path(path))
+        except OSError:
+            pass
+        with self.lock:
+            if key in self.index:
+                self.total_bytes -= self.index[key][1]
+            self.index[key] = (path, size, time.time())
+            self.total_bytes += size
+        self.evict()
+        return path
+
+    def add_sidecar(self, path, size):
+        """Count the Opus sidecar written for a cached clip towards the size limit."""
+        key = os.path.splitext(os.path.basename(path))[0]
+        with self.lock:
+            entry = self.index.get(key)
+            if entry is None or entry[0] != path:
+                return
+            self.index[key] = (entry[0], entry[1] + size, entry[2])
+            self.total_bytes += size
+        self.evict()
+
+    def new_temp_path(self):
+        """Return a temporary path inside the cache directory for an in-progress write."""
+        fd, temp_path = tempfile.mkstemp(suffix='.tmp', dir=self.directory)
+        os.close(fd)
+        return temp_path
+
+    def contains(self, key):
+        """Return True if a key is cached, without touching the hit/miss counters."""
+        with self.lock:
+            return key in self.index
+
+    def invalidate(self, key):
+        """Remove a single entry from the cache."""
+        with self.lock:
+            self._remove(key)
+
+    def contains_path(self, path):
+        """Return True if the path points to a file managed by the cache."""
+        return os.path.dirname(os.path.abspath(path)) == os.path.abspath(self.directory)
+
+    def evict(self):
+        """Drop expired entries, then least recently used entries until under the size limit."""
+        now = time.time()
+        with self.lock:
+            for key in [k for k, (_, _, created) in self.index.items() if now - created > self.max_age_seconds]:
+                self._remove(key)
+            while self.index and self.total_bytes > self.max_bytes:
+                self._remove(next(iter(self.index)))
+
+    def _remove(self, key):
+        entry = self.index.pop(key, None)
+        if entry is None:
+            return
+        path, size, _ = entry
+        self.total_bytes -= size
+        for stale_path in (path, opus_sidecar_path(path)):
+            try:
+                os.unlink(stale_path)
+            except OSError:
+                pass
+
+tts_cache = TTSCache(TTS_CACHE_DIR, TTS_CACHE_MAX_MB * 1048576, TTS_CACHE_MAX_AGE_DAYS * 86400)
+if TTS_CACHE_ENABLED:
+    try:
+        tts_cache.load()
+    except Exception as e:
+        logger.error(f"Error loading TTS cache, caching disabled: {e}")
+        TTS_CACHE_ENABLED = False
+
+def percentile(sorted_values, fraction):
+    """Return the value at the given fraction (0-1) of an already sorted list."""
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * fraction))]
+
+class TTSBackend:
+    """Base class for text-to-speech engines. Tracks latency of its own calls."""
+    name = None
+    # Whether stream() yields audio while synthesis is still running
+    streaming = False
+
+    def __init__(self):
+        self.calls = 0
+        self.failures = 0
+        self.latencies = deque(maxlen=200)
+        self.lock = threading.Lock()
+
+    def synthesize(self, text, language, path):
+        """Write speech for text to path. Blocking."""
+        raise NotImplementedError
+
+    def stream(self, text, language):
+        """Yield chunks of encoded audio for text as they are produced. Blocking."""
+        raise NotImplementedError
+
+    def record(self, duration, success):
+        """Record the duration of a synthesis call."""
+        with self.lock:
+            self.calls += 1
+            if not success:
+                self.failures += 1
+            self.latencies.append(duration)
+
+    def stats(self):
+        """Return call counts and latency percentiles (in seconds) over recent calls."""
+        with self.lock:
+            latencies = sorted(self.latencies)
+            calls, failures = self.calls, self.failures
+        if not latencies:
+            return {"calls": calls, "failures": failures, "avg": None, "p50": None, "p95": None}
+        return {
+            "calls": calls,
+            "failures": failures,
+            "avg": sum(latencies) / len(latencies),
+            "p50": percentile(latencies, 0.5),
+            "p95": percentile(latencies, 0.95)
+        }
+
+class GTTSBackend(TTSBackend):
+    """Google Translate TTS. Requires network access."""
+    name = "gtts"
+    streaming = True
+
+    def synthesize(self, text, language, path):
+        # Bound each request so a hung call cannot hold a TTS worker forever
+        tts = gTTS(text=text, lang=language, slow=False, timeout=TTS_TIMEOUT)
+        tts.save(path)
+
+    def stream(self, text, language):
+        # gTTS fetches long texts in segments and yields each as it arrives
+        yield from gTTS(text=text, lang=language, slow=False, timeout=TTS_TIMEOUT).stream()
+
+class EspeakBackend(TTSBackend):
+    """Local, offline synthesis with espeak-ng."""
+    name = "espeak"
+    streaming = True
+
+    def synthesize(self, text, language, path):
+        subprocess.run(
+            ['espeak-ng', '-v', language, '-w', path, text],
+            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, check=True, timeout=TTS_TIMEOUT
+        )
+
+    def stream(self, text, language):
+        process = subprocess.Popen(['espeak-ng', '-v', language, '--stdout', text],
+                                   stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        try:
+            while chunk := process.stdout.read1(16384):
+                yield chunk
+        except GeneratorExit:
+            # The consumer stopped early
+            process.kill()
+            raise
+        finally:
+            process.stdout.close()
+            process.wait()
+        if process.returncode != 0:
+            raise RuntimeError(f"espeak-ng exited with status {process.returncode}")
+
+class FakeBackend(TTSBackend):
+    """
+    Deterministic backend for tests and benchmarks. Writes a silent WAV whose
+    length depends on the number of words, after FAKE_TTS_LATENCY seconds.
+    """
+    name = "fake"
+    streaming = True
+    sample_rate = 16000
+
+    def synthesize(self, text, language, path):
+        if FAKE_TTS_LATENCY > 0:
+            time.sleep(FAKE_TTS_LATENCY)
+        frames = int(self.sample_rate * 0.3 * max(1, len(text.split())))
+        with wave.open(path, 'wb') as f:
+            f.setnchannels(1)
+            f.setsampwidth(2)
+            f.setframerate(self.sample_rate)
+            f.writeframes(b'\x00\x00' * frames)
+
+    def stream(self, text, language):
+        # One chunk per word, with the latency spread over the words
+        words = max(1, len(text.split()))
+        word_bytes = int(self.sample_rate * 0.3) * 2
+        data_size = word_bytes * words
+        yield struct.pack('<4sI4s4sIHHIIHH4sI', b'RIFF', 36 + data_size, b'WAVE', b'fmt ', 16, 1, 1,
+                          self.sample_rate, self.sample_rate * 2, 2, 16, b'data', data_size)
+        for _ in range(words):
+            if FAKE_TTS_LATENCY > 0:
+                time.sleep(FAKE_TTS_LATENCY / words)
+            yield b'\x00' * word_bytes
+
+TTS_BACKENDS = {backend.name: backend for backend in (GTTSBackend, EspeakBackend, FakeBackend)}
+if TTS_BACKEND not in TTS_BACKENDS:
+    logger.error(f"Unknown TTS_BACKEND '{TTS_BACKEND}', falling back to gtts")
+    TTS_BACKEND = "gtts"
+tts_backend = TTS_BACKENDS[TTS_BACKEND]()
+
+# Dedicated worker pool so blocking TTS calls never stall the event loop
+tts_executor = ThreadPoolExecutor(max_workers=TTS_MAX_WORKERS, thread_name_prefix='tts')
+# Separate pool for work on audio that is already synthesized (Opus encoding,
+# sidecar reads, phrase composition), so cached announcements never wait
+# behind slow syntheses
+audio_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='audio')
+
+# Job priorities, most urgent first: synthesis for live announcements, then pre-warming
+PRIORITY_LIVE = 0
+PRIORITY_PREWARM = 1
+PRIORITY_NAMES = {PRIORITY_LIVE: "live", PRIORITY_PREWARM: "prewarm"}
+
+class ScheduledJob:
+    """A blocking call waiting for or running on a TTS worker."""
+    __slots__ = ('func', 'args', 'guild_id', 'priority', 'key', 'future', 'submitted', 'started', 'tag')
+
+    def __init__(self, func, args, guild_id, priority, key, future):
+        self.func = func
+        self.args = args
+        self.guild_id = guild_id
+        self.priority = priority
+        self.key = key
+        self.future = future
+        self.submitted = time.monotonic()
+        self.started = False
+        self.tag = None
+
+class FairScheduler:
+    """
+    Runs blocking jobs on an executor with at most `capacity` at once.
+    Waiting jobs are ordered by priority, then by start-time fair queuing
+    tags per guild, so a guild in a burst cannot push other guilds' jobs
+    back. No guild may run more than `guild_quota` jobs at once while other
+    guilds have jobs waiting; otherwise free workers are never left idle.
+    """
+
+    def __init__(self, executor, capacity, guild_quota, weights=None):
+        self.executor = executor
+        self.capacity = capacity
+        self.guild_quota = guild_quota
+        self.weights = weights or {}
+        self.waiting = []  # heap of (priority, tag, seq, job)
+        self.keyed = {}  # key -> waiting job, for promotion
+        self.running = 0
+        self.running_per_guild = {}
+        self.guild_tags = {}  # guild ID -> finish tag of its last job
+        self.virtual_time = 0.0
+        self.sequence = itertools.count()
+
+    def submit(self, func, *args, guild_id=None, priority=PRIORITY_LIVE, key=None):
+        """Queue a call and return an asyncio future for its result. Cancelling the future drops a waiting job."""
+        job = ScheduledJob(func, args, guild_id, priority, key, asyncio.get_running_loop().create_future())
+        if key is not None:
+            self.keyed[key] = job
+        self.push(job, priority)
+        self.dispatch()
+        return job.future
+
+    def promote(self, key, priority, guild_id=None):
+        """Move a waiting job to a more urgent priority, e.g. when a live announcement needs a clip being pre-warmed."""
+        job = self.keyed.get(key)
+        if job is None or job.started or priority >= job.priority:
+            return
+        job.priority = priority
+        job.guild_id = guild_id
+        self.push(job, priority)
+        self.dispatch()
+
+    def push(self, job, priority):
+        # A promoted job keeps the tag it was charged when first submitted;
+        # its old heap entry is skipped as stale
+        if job.tag is None:
+            weight = self.weights.get(job.guild_id, 1.0)
+            job.tag = max(self.virtual_time, self.guild_tags.get(job.guild_id, 0.0))
+            self.guild_tags[job.guild_id] = job.tag + 1 / weight
+        heapq.heappush(self.waiting, (priority, job.tag, next(self.sequence), job))
+
+    def dispatch(self):
+        """Start waiting jobs while workers are free."""
+        deferred = []
+        while self.waiting and self.running < self.capacity:
+            entry = heapq.heappop(self.waiting)
+            priority, tag, _, job = entry
+            # Skip cancelled jobs and stale entries of promoted jobs
+            if job.started or job.future.done() or priority != job.priority:
+                self.forget(job)
+                continue
+            if self.running_per_guild.get(job.guild_id, 0) >= self.guild_quota:
+                deferred.append(entry)
+                continue
+            self.virtual_time = max(self.virtual_time, tag)
+            self.start(job)
+        # Every job left is from a guild at its quota, so nobody else is waiting
+        while deferred and self.running < self.capacity:
+            _, tag, _, job = deferred.pop(0)
+            self.virtual_time = max(self.virtual_time, tag)
+            self.start(job)
+        for entry in deferred:
+            heapq.heappush(self.waiting, entry)
+
+    def forget(self, job):
+        if job.key is not None and self.keyed.get(job.key) is job and (job.started or job.future.done()):
+            del self.keyed[job.key]
+
+    def start(self, job):
+        job.started = True
+        self.forget(job)
+        self.running += 1
+        self.running_per_guild[job.guild_id] = self.running_per_guild.get(job.guild_id, 0) + 1
+        TTS_QUEUE_WAIT_SECONDS.labels(PRIORITY_NAMES[job.priority]).observe(time.monotonic() - job.submitted)
+        loop = job.future.get_loop()
+        work = self.executor.submit(job.func, *job.args)
+        work.add_done_callback(lambda work: loop.call_soon_threadsafe(self.finished, job, work))
+
+    def finished(self, job, work):
+        """Release the worker slot once the thread is done, even if the caller gave up waiting."""
+        self.running -= 1
+        self.running_per_guild[job.guild_id] -= 1
+        if not self.running_per_guild[job.guild_id]:
+            del self.running_per_guild[job.guild_id]
+        if not job.future.done():
+            if work.exception() is not None:
+                job.future.set_exception(work.exception())
+            else:
+                job.future.set_result(work.result())
+        self.dispatch()
+
+    def queued(self):
+        """Return the number of waiting jobs."""
+        return sum(1 for priority, _, _, job in self.waiting
+                   if priority == job.priority and not job.started and not job.future.done())
+
+tts_scheduler = FairScheduler(tts_executor, TTS_MAX_WORKERS, TTS_GUILD_CONCURRENCY, TTS_GUILD_WEIGHTS)
+TTS_QUEUED_JOBS.set_function(tts_scheduler.queued)
+
+class TTSStream:
+    """
+    In-memory pipe from a TTS backend producing audio on a worker thread to
+    FFmpeg reading it for playback. Reads block until audio arrives or the
+    stream ends; a stream that stalls for TTS_TIMEOUT seconds is ended.
+    """
+
+    def __init__(self, text):
+        self.text = text
+        self.chunks = deque()
+        self.closed = False
+        self.cancelled = False
+        self.condition = threading.Condition()
+        self.loop = asyncio.get_running_loop()
+        self.first_audio = self.loop.create_future()
+        self.job = None
+        # Other announcements waiting for the finished clip, if any
+        self.shared = None
+        self.stopped = False
+
+    def write(self, data):
+        with self.condition:
+            if self.cancelled:
+                return
+            self.chunks.append(data)
+            self.condition.notify_all()
+        if not self.first_audio.done():
+            self.loop.call_soon_threadsafe(self.set_first_audio, None)
+
+    def close(self, error=None):
+        """End the stream. An error before any audio fails the wait for first audio."""
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        if not self.first_audio.done():
+            self.loop.call_soon_threadsafe(self.set_first_audio, error or RuntimeError("TTS stream ended without audio"))
+
+    def set_first_audio(self, error):
+        if self.first_audio.done():
+            return
+        if self.chunks:
+            self.first_audio.set_result(None)
+        elif error is not None:
+            self.first_audio.set_exception(error)
+
+    def cancel(self):
+        """
+        End the stream, e.g. when playback stopped early. The producer is
+        stopped too, unless other announcements are waiting for the clip.
+        """
+        with self.condition:
+            if self.closed:
+                return
+            self.cancelled = self.closed = True
+            self.condition.notify_all()
+        if not self.first_audio.done():
+            self.first_audio.cancel()
+        if self.shared is None or not self.shared.waiters:
+            self.stopped = True
+            if self.job is not None:
+                self.job.cancel()
+
+    def read(self, size=-1):
+        with self.condition:
+            while not self.chunks and not self.closed:
+                if not self.condition.wait(TTS_TIMEOUT):
+                    logger.error(f"TTS stream stalled, ending playback of '{self.text}'")
+                    self.closed = True
+            if not self.chunks:
+                return b''
+            data = self.chunks.popleft()
+            if 0 < size < len(data):
+                self.chunks.appendleft(data[size:])
+                data = data[:size]
+            return data
+
+# In-flight synthesis jobs keyed by cache key
+pending_tts_jobs = {}
+
+class SharedSynthesis:
+    """A synthesis task (or future) shared by every caller waiting for the same text."""
+    __slots__ = ('task', 'waiters')
+
+    def __init__(self, task):
+        self.task = task
+        self.waiters = 0
+
+    async def wait(self):
+        """Wait for the result. The synthesis is only cancelled when its last waiter is."""
+        self.waiters += 1
+        try:
+            return await asyncio.shield(self.task)
+        except asyncio.CancelledError:
+            if self.waiters == 1:
+                self.task.cancel()
+            raise
+        finally:
+            self.waiters -= 1
+
+class OpusFrameSource(discord.AudioSource):
+    """Audio source that plays already encoded Opus frames without spawning FFmpeg."""
+
+    def __init__(self, frames):
+        self.frames = frames
+        self.position = 0
+
+    def read(self):
+        if self.position >= len(self.frames):
+            return b''
+        frame = self.frames[self.position]
+        self.position += 1
+        return frame
+
+    def is_opus(self):
+        return True
+
+class OpusFrameCache:
+    """In-memory LRU of encoded Opus frames, keyed by clip path and modification time."""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()  # (path, mtime) -> (frames, size)
+        self.total_bytes = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            self.entries.move_to_end(key)
+            return entry[0]
+
+    def put(self, key, frames):
+        size = sum(len(frame) for frame in frames)
+        with self.lock:
+            if key in self.entries:
+                self.total_bytes -= self.entries.pop(key)[1]
+            self.entries[key] = (frames, size)
+            self.total_bytes += size
+            while len(self.entries) > 1 and self.total_bytes > self.max_bytes:
+                _, (_, evicted_size) = self.entries.popitem(last=False)
+                self.total_bytes -= evicted_size
+
+def decode_pcm(path):
+    """Decode an audio file to 48 kHz stereo 16-bit PCM with FFmpeg. Blocking."""
+    result = subprocess.run(
+        ['ffmpeg', '-hide_banner', '-loglevel', 'error', '-i', path,
+         '-f', 's16le', '-ar', '48000', '-ac', '2', 'pipe:1'],
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True
+    )
+    return result.stdout
+
+def encode_opus_frames(path):
+    """
+    Decode an MP3 once with FFmpeg and encode it to 20 ms Opus frames.
+    Blocking; runs on the audio executor.
+    """
+    pcm = decode_pcm(path)
+    encoder = discord.opus.Encoder()
+    frame_size = discord.opus.Encoder.FRAME_SIZE
+    frames = []
+    for offset in range(0, len(pcm), frame_size):
+        chunk = pcm[offset:offset + frame_size]
+        if len(chunk) < frame_size:
+            chunk += b'\x00' * (frame_size - len(chunk))
+        frames.append(encoder.encode(chunk, discord.opus.Encoder.SAMPLES_PER_FRAME))
+    return frames
+
+def trim_silence(samples, threshold=PHRASE_SILENCE_THRESHOLD, padding=960):
+    """
+    Strip leading and trailing near-silence from interleaved stereo samples,
+    keeping a short pad (padding is in samples, 960 = 10 ms of stereo audio).
+    """
+    start = 0
+    while start < len(samples) and abs(samples[start]) < threshold:
+        start += 1
+    end = len(samples)
+    while end > start and abs(samples[end - 1]) < threshold:
+        end -= 1
+    start = max(0, start - padding) & ~1
+    end = min(len(samples), end + padding)
+    end -= (end - start) % 2
+    return samples[start:end]
+
+def compose_phrase(first_path, second_path, output_path):
+    """
+    Join two clips into one WAV, trimming the silence around the seam and
+    crossfading PHRASE_CROSSFADE_MS between them. Blocking; runs on the audio executor.
+    """
+    first = trim_silence(array('h', decode_pcm(first_path)))
+    second = trim_silence(array('h', decode_pcm(second_path)))
+    overlap = min(len(first), len(second), int(48000 * PHRASE_CROSSFADE_MS / 1000) * 2)
+    overlap -= overlap % 2
+    
+    combined = first[:len(first) - overlap]
+    for i in range(overlap):
+        fade = (i // 2) / max(1, overlap // 2)
+        mixed = first[len(first) - overlap + i] * (1 - fade) + second[i] * fade
+        combined.append(max(-32768, min(32767, int(mixed))))
+    combined.extend(second[overlap:])
+    
+    with wave.open(output_path, 'wb') as f:
+        f.setnchannels(2)
+        f.setsampwidth(2)
+        f.setframerate(48000)
+        f.writeframes(combined.tobytes())
+
+def read_opus_sidecar(path):
+    """Read length-prefixed Opus frames from a sidecar file."""
+    frames = []
+    with open(path, 'rb') as f:
+        data = f.read()
+    offset = 0
+    while offset < len(data):
+        (length,) = struct.unpack_from('>H', data, offset)
+        offset += 2
+        frames.append(data[offset:offset + length])
+        offset += length
+    return frames
+
+def write_opus_sidecar(path, frames):
+    """Atomically write Opus frames as a length-prefixed sidecar file."""
+    temp_path = path + '.tmp'
+    with open(temp_path, 'wb') as f:
+        for frame in frames:
+            f.write(struct.pack('>H', len(frame)))
+            f.write(frame)
+    os.replace(temp_path, path)
+
+def cached_opus_frames(path):
+    """Return the in-memory Opus frames for a clip, or None if they are not loaded."""
+    try:
+        return opus_frame_cache.get((path, os.path.getmtime(path)))
+    except OSError:
+        return None
+
+def load_opus_frames(path):
+    """
+    Return the Opus frames for a cached clip, reading them from the sidecar
+    file or encoding them on first use. Blocking; runs on the audio executor.
+    """
+    mtime = os.path.getmtime(path)
+    frames = opus_frame_cache.get((path, mtime))
+    if frames is not None:
+        return frames
+    
+    sidecar = opus_sidecar_path(path)
+    if os.path.exists(sidecar) and os.path.getmtime(sidecar) >= mtime:
+        frames = read_opus_sidecar(sidecar)
+    else:
+        frames = encode_opus_frames(path)
+        write_opus_sidecar(sidecar, frames)
+        tts_cache.add_sidecar(path, os.path.getsize(sidecar))
+    opus_frame_cache.put((path, mtime), frames)
+    return frames
+
+opus_frame_cache = OpusFrameCache(OPUS_MEMORY_CACHE_MB * 1048576)
+
+# Open the state database, importing the legacy JSON files on first run
+state_db = open_state_db()
+import_legacy_json(state_db)
+
 # Load custom announcements at startup
 load_custom_announcements()
 
 # Load whitelist at startup
 load_whitelist()
 
-@bot.event
-async def on_ready():
-    """Event triggered when the bot is ready and connected to Discord."""
-    logger.info(f'{bot.user.name} is connected to Discord!')
-    logger.info(f'Bot is active in {len(bot.guilds)} servers')
+# Build the announcement profile index
+rebuild_announcement_profiles()
+
+# Apply settings changed through the admin API in a previous run
+load_runtime_settings()
+
+# Voice event recorder; writes happen on a listener thread, not the event loop
+event_recorder = None
+event_recorder_listener = None
+event_record_salt = None
+
+def start_event_recorder():
+    """
+    Start writing voice state events to a rotating JSON lines file. IDs are
+    replaced with keyed hashes so the log can be shared; the key is kept in
+    the state database so IDs stay consistent across restarts.
+    """
+    global event_recorder, event_recorder_listener, event_record_salt
+    if not EVENT_RECORD_ENABLED or event_recorder is not None:
+        return
     
-    # Initialize the users_in_voice dictionary
-    for guild in bot.guilds:
-        users_in_voice[guild.id] = set()
-        for voice_channel in guild.voice_channels:
-            for member in voice_channel.members:
-                users_in_voice[guild.id].add(member.id)
+    try:
+        row = state_db.execute("SELECT value FROM meta WHERE key = 'event_record_salt'").fetchone()
+        if row is None:
+            with state_db:
+                state_db.execute("INSERT OR IGNORE INTO meta VALUES ('event_record_salt', ?)", (os.urandom(16).hex(),))
+            row = state_db.execute("SELECT value FROM meta WHERE key = 'event_record_salt'").fetchone()
+        event_record_salt = bytes.fromhex(row["value"])
+        
+        os.makedirs(os.path.dirname(os.path.abspath(EVENT_RECORD_PATH)), exist_ok=True)
+        file_handler = logging.handlers.RotatingFileHandler(
+            EVENT_RECORD_PATH, maxBytes=int(EVENT_RECORD_MAX_MB * 1048576), backupCount=EVENT_RECORD_BACKUPS
+        )
+        file_handler.setFormatter(logging.Formatter('%(message)s'))
+        records = SimpleQueue()
+        event_recorder_listener = logging.handlers.QueueListener(records, file_handler)
+        event_recorder_listener.start()
+        atexit.register(event_recorder_listener.stop)
+        
+        event_recorder = logging.getLogger('discord_bot.events')
+        event_recorder.propagate = False
+        event_recorder.setLevel(logging.INFO)
+        event_recorder.addHandler(logging.handlers.QueueHandler(records))
+        logger.info(f"Recording voice state events to {EVENT_RECORD_PATH}")
+    except Exception as e:
+        event_recorder = None
+        logger.error(f"Error starting voice event recorder: {e}")
+
+def anonymize_id(value):
+    """Map a Discord ID to a stable pseudonymous 63-bit integer."""
+    digest = hmac.new(event_record_salt, str(value).encode(), hashlib.sha256).digest()
+    return int.from_bytes(digest[:8], 'big') >> 1
+
+def record_voice_event(member, before, after):
+    """Append one voice state change to the event log."""
+    event_recorder.info(json.dumps({
+        "t": round(time.time(), 3),
+        "g": anonymize_id(member.guild.id),
+        "u": anonymize_id(member.id),
+        "b": anonymize_id(before.channel.id) if before.channel else None,
+        "a": anonymize_id(after.channel.id) if after.channel else None
+    }, separators=(',', ':')))
+
+start_event_recorder()
+
+def read_state_snapshot():
+    """Read custom announcements and the whitelist on a fresh connection. Blocking; runs off the event loop."""
+    conn = sqlite3.connect(STATE_DB_PATH, timeout=10)
+    conn.row_factory = sqlite3.Row
+    try:
+        users = {}
+        for row in conn.execute("SELECT * FROM custom_announcements"):
+            entry = {"display_name": row["display_name"] or "Unknown User"}
+            if row["join_message"]:
+                entry["join_message"] = row["join_message"]
+            if row["leave_message"]:
+                entry["leave_message"] = row["leave_message"]
+            users[row["user_id"]] = entry
+        whitelist_ids = {row["user_id"] for row in conn.execute("SELECT user_id FROM whitelist")}
+        return users, whitelist_ids
+    finally:
+        conn.close()
+
+async def reload_state():
+    """Reload the state database and apply only the entries that changed."""
+    loop = asyncio.get_running_loop()
+    try:
+        users, whitelist_ids = await loop.run_in_executor(None, read_state_snapshot)
+    except Exception as e:
+        logger.error(f"Error reloading state database: {e}")
+        return
+    
+    current_users = custom_announcements["users"]
+    changed = set()
+    for user_id in set(current_users) | set(users):
+        if user_id != "_comment" and current_users.get(user_id) != users.get(user_id):
+            changed.add(user_id)
+            if user_id in users:
+                current_users[user_id] = users[user_id]
+            else:
+                current_users.pop(user_id, None)
+    
+    whitelist_changes = announcement_whitelist ^ whitelist_ids
+    if whitelist_changes:
+        announcement_whitelist.intersection_update(whitelist_ids)
+        announcement_whitelist.update(whitelist_ids)
+        changed |= whitelist_changes
+    
+    for user_id in changed:
+        apply_announcement_change(user_id)
+    if changed:
+        logger.info(f"Reloaded state database: {len(changed)} users changed")
+
+def schedule_state_reload():
+    """Debounce bursts of file events into a single reload."""
+    global state_reload_handle
+    if state_reload_handle is not None:
+        state_reload_handle.cancel()
+    loop = asyncio.get_running_loop()
+    state_reload_handle = loop.call_later(0.25, lambda: asyncio.ensure_future(reload_state()))
+
+def start_inotify_watch(directory, filenames):
+    """
+    Watch a directory with inotify and reload state when one of the files
+    changes. Returns False if inotify is unavailable.
+    """
+    libc_name = ctypes.util.find_library('c')
+    if not libc_name:
+        return False
+    libc = ctypes.CDLL(libc_name, use_errno=True)
+    if not hasattr(libc, 'inotify_init1'):
+        return False
+    
+    fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+    if fd < 0:
+        return False
+    mask = 0x00000002 | 0x00000008 | 0x00000080 | 0x00000100  # IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+    if libc.inotify_add_watch(fd, os.fsencode(directory), mask) < 0:
+        os.close(fd)
+        return False
+    
+    def on_events():
+        try:
+            data = os.read(fd, 65536)
+        except BlockingIOError:
+            return
+        offset = 0
+        while offset < len(data):
+            _, _, _, name_length = struct.unpack_from('iIII', data, offset)
+            name = data[offset + 16:offset + 16 + name_length].rstrip(b'\0').decode(errors='replace')
+            offset += 16 + name_length
+            if name in filenames:
+                schedule_state_reload()
+                break
+    
+    asyncio.get_running_loop().add_reader(fd, on_events)
+    return True
+
+async def poll_state_files(paths):
+    """Fallback watcher: reload state when the mtime or size of a file changes."""
+    def signature():
+        result = []
+        for path in paths:
+            try:
+                stat = os.stat(path)
+                result.append((stat.st_mtime_ns, stat.st_size))
+            except OSError:
+                result.append(None)
+        return result
+    
+    last = signature()
+    while True:
+        await asyncio.sleep(STATE_POLL_INTERVAL)
+        current = signature()
+        if current != last:
+            last = current
+            schedule_state_reload()
+
+def start_state_watcher():
+    """Start watching the state database for changes made by the web interface."""
+    global state_watcher_started
+    if state_watcher_started or not STATE_WATCH_ENABLED:
+        return
+    state_watcher_started = True
     
+    directory = os.path.dirname(os.path.abspath(STATE_DB_PATH))
+    db_name = os.path.basename(STATE_DB_PATH)
+    filenames = {db_name, db_name + '-wal'}
+    try:
+        if start_inotify_watch(directory, filenames):
+            logger.info(f"Watching {STATE_DB_PATH} for changes with inotify")
+            return
+    except Exception as e:
+        logger.warning(f"inotify unavailable, falling back to polling: {e}")
+    
+    logger.info(f"Polling {STATE_DB_PATH} for changes every {STATE_POLL_INTERVAL}s")
+    state_poll_tasks.append(asyncio.create_task(
+        poll_state_files([os.path.join(directory, name) for name in sorted(filenames)])
+    ))
+
+# Admin API endpoints that do not require the admin token
+ADMIN_PUBLIC_PATHS = {'/health', '/metrics'}
+
+@web.middleware
+async def admin_auth_middleware(request, handler):
+    """Require the admin token for everything except the health check and metrics."""
+    if request.path not in ADMIN_PUBLIC_PATHS:
+        expected = f"Bearer {ADMIN_API_TOKEN}"
+        if not ADMIN_API_TOKEN or not hmac.compare_digest(request.headers.get('Authorization', ''), expected):
+            return web.json_response({"status": "error", "message": "Unauthorized"}, status=401)
+    return await handler(request)
+
+async def admin_health(request):
+    """Health check used by the Docker HEALTHCHECK."""
+    return web.json_response({"status": "ok", "ready": bot.is_ready(), "guilds": len(bot.guilds),
+                              "shards": {str(shard_id): health for shard_id, health in shard_health.items()}})
+
+async def admin_metrics(request):
+    """Expose Prometheus metrics for scraping."""
+    response = web.Response(body=generate_latest())
+    response.headers['Content-Type'] = CONTENT_TYPE_LATEST
+    return response
+
+async def admin_get_settings(request):
+    """Return the live runtime settings."""
+    return web.json_response({"status": "success", "settings": get_runtime_settings()})
+
+async def admin_update_settings(request):
+    """Apply runtime settings live and persist them."""
+    try:
+        data = await request.json()
+        if not isinstance(data, dict):
+            raise ValueError("Expected a JSON object")
+        changed = apply_runtime_settings(data)
+    except ValueError as e:
+        return web.json_response({"status": "error", "message": str(e)}, status=400)
+    
+    if changed:
+        save_runtime_settings(changed)
+        logger.info(f"Settings updated through admin API: {', '.join(changed)}")
+        if {'ANNOUNCE_JOINS', 'ANNOUNCE_LEAVES'} & set(changed) and bot.is_ready():
+            await update_presence()
+    return web.json_response({"status": "success", "changed": changed, "settings": get_runtime_settings()})
+
+async def admin_reload(request):
+    """Reload custom announcements and the whitelist from the state database."""
+    await reload_state()
+    return web.json_response({"status": "success"})
+
+async def start_admin_api():
+    """Start the admin HTTP server on the bot's event loop."""
+    global admin_api_runner
+    if not ADMIN_API_ENABLED or admin_api_runner is not None:
+        return
+    if not ADMIN_API_TOKEN:
+        logger.warning("ADMIN_API_TOKEN is not set; only the /health and /metrics endpoints of the admin API are available")
+    
+    app = web.Application(middlewares=[admin_auth_middleware])
+    app.router.add_get('/health', admin_health)
+    app.router.add_get('/metrics', admin_metrics)
+    app.router.add_get('/api/settings', admin_get_settings)
+    app.router.add_post('/api/settings', admin_update_settings)
+    app.router.add_post('/api/reload', admin_reload)
+    
+    admin_api_runner = web.AppRunner(app, access_log=None)
+    await admin_api_runner.setup()
+    await web.TCPSite(admin_api_runner, ADMIN_API_HOST, ADMIN_API_PORT).start()
+    logger.info(f"Admin API listening on {ADMIN_API_HOST}:{ADMIN_API_PORT}")
+
+async def setup_hook():
+    """Start background services before the bot connects to Discord."""
+    try:
+        await start_admin_api()
+    except Exception as e:
+        logger.error(f"Error starting admin API: {e}")
+
+bot.setup_hook = setup_hook
+
+async def update_presence():
+    """Set the bot's activity to reflect which announcements are enabled."""
     if ANNOUNCE_JOINS and ANNOUNCE_LEAVES:
         activity_name = "voice channel activity"
     elif ANNOUNCE_JOINS:
@@ -136,6 +1613,236 @@ async def on_ready():
         name=activity_name
     ))
 
+def get_shard_health(shard_id):
+    """Return the health counters of a shard, creating them on first use."""
+    return shard_health.setdefault(shard_id or 0, {"connected": False, "disconnects": 0, "since": None, "events": 0})
+
+def set_shard_connected(shard_id, connected):
+    """Record a shard connecting to or disconnecting from the gateway."""
+    health = get_shard_health(shard_id)
+    if health["connected"] != connected:
+        health["since"] = time.time()
+    if health["connected"] and not connected:
+        health["disconnects"] += 1
+    health["connected"] = connected
+
+@bot.event
+async def on_shard_ready(shard_id):
+    logger.info(f"Shard {shard_id} is ready")
+    set_shard_connected(shard_id, True)
+
+@bot.event
+async def on_shard_connect(shard_id):
+    set_shard_connected(shard_id, True)
+
+@bot.event
+async def on_shard_resumed(shard_id):
+    set_shard_connected(shard_id, True)
+
+@bot.event
+async def on_shard_disconnect(shard_id):
+    logger.warning(f"Shard {shard_id} disconnected")
+    set_shard_connected(shard_id, False)
+
+@bot.event
+async def on_ready():
+    """Event triggered when the bot is ready and connected to Discord."""
+    logger.info(f'{bot.user.name} is connected to Discord!')
+    logger.info(f'Bot is active in {len(bot.guilds)} servers')
+    if SHARDING_ENABLED:
+        logger.info(f'Running shards {sorted(bot.shards)} of {bot.shard_count}')
+    else:
+        set_shard_connected(0, True)
+    
+    await update_presence()
+    
+    # on_ready fires again after reconnects; the rest only needs to run once
+    global bot_ready_once
+    if bot_ready_once:
+        return
+    bot_ready_once = True
+    STARTUP_READY_SECONDS.set(time.monotonic() - process_started)
+    
+    # Pick up edits made through the web interface without a restart
+    start_state_watcher()
+    
+    # Warm the audio cache for known users in the background
+    global prewarm_task
+    if PREWARM_ENABLED and TTS_CACHE_ENABLED and prewarm_task is None:
+        prewarm_task = asyncio.create_task(prewarm_announcements(collect_prewarm_clips()))
+
+def ensure_guild_presence(guild):
+    """
+    Build a guild's voice presence from the member cache the first time the
+    guild is seen or after an outage. Returns True if it was built now.
+    """
+    if voice_presence.has_guild(guild.id):
+        return False
+    start = time.perf_counter()
+    voice_presence.add_guild(guild.id, (
+        (member.id, voice_channel.id) for voice_channel in guild.voice_channels for member in voice_channel.members
+    ))
+    PRESENCE_INIT_SECONDS.observe(time.perf_counter() - start)
+    return True
+
+@bot.event
+async def on_guild_available(guild):
+    """Build a guild's voice presence as soon as its state arrives from the gateway."""
+    ensure_guild_presence(guild)
+
+@bot.event
+async def on_guild_unavailable(guild):
+    """Forget a guild's voice presence during an outage; it is rebuilt when the guild becomes available again."""
+    voice_presence.remove_guild(guild.id)
+
+@bot.event
+async def on_guild_join(guild):
+    ensure_guild_presence(guild)
+
+@bot.event
+async def on_guild_remove(guild):
+    voice_presence.remove_guild(guild.id)
+
+def collect_prewarm_clips():
+    """
+    Build the (text, parts) announcements worth synthesizing ahead of time: members
+    currently in voice first, then users with custom messages or on the whitelist.
+    """
+    names = {}
+    for guild in bot.guilds:
+        for voice_channel in guild.voice_channels:
+            for member in voice_channel.members:
+                if not member.bot:
+                    names.setdefault(str(member.id), member.display_name)
+    
+    for user_id in announcement_profiles:
+        if user_id in names:
+            continue
+        member = None
+        for guild in bot.guilds:
+            member = guild.get_member(int(user_id))
+            if member:
+                break
+        if member:
+            names[user_id] = member.display_name
+        elif isinstance(custom_announcements["users"].get(user_id), dict):
+            names[user_id] = custom_announcements["users"][user_id].get("display_name")
+    
+    clips = []
+    for user_id, username in names.items():
+        if not username:
+            continue
+        profile = get_announcement_profile(user_id)
+        if WHITELIST_MODE and not profile["whitelisted"]:
+            continue
+        for enabled, message_key, action in ((ANNOUNCE_JOINS, "join_message", "joined"),
+                                             (ANNOUNCE_LEAVES, "leave_message", "left")):
+            if not enabled:
+                continue
+            custom_msg = profile[message_key]
+            if custom_msg:
+                # A malformed custom message only loses its own clip
+                try:
+                    clips.append((custom_msg.format(username=username), None))
+                except (KeyError, IndexError, ValueError) as e:
+                    logger.warning(f"Skipping pre-warm of invalid custom message for user {user_id}: {e!r}")
+            else:
+                parts = default_announcement_parts([username], action)
+                clips.append((" ".join(parts), parts))
+    return list(dict.fromkeys(clips))
+
+async def prewarm_announcements(clips):
+    """
+    Synthesize announcement audio ahead of time at low priority.
+    Already cached clips are skipped, new syntheses are limited to
+    PREWARM_RATE per second, and work pauses while announcements are playing.
+    """
+    prewarm_state.update({"total": len(clips), "done": 0, "synthesized": 0, "failed": 0,
+                          "started": time.time(), "finished": None})
+    logger.info(f"Pre-warming announcement audio for {len(clips)} clips")
+    
+    for text, parts in clips:
+        # Live announcements take priority over pre-warming
+        while any(not worker.done() for worker in playback_workers.values()):
+            await asyncio.sleep(1)
+        
+        cached = tts_cache.contains(TTSCache.make_key(text, VOICE_LANGUAGE, TTS_BACKEND))
+        try:
+            await prepare_announcement_audio(text, parts, priority=PRIORITY_PREWARM)
+            if not cached:
+                prewarm_state["synthesized"] += 1
+        except Exception as e:
+            prewarm_state["failed"] += 1
+            ERRORS.labels('tts').inc()
+            logger.warning(f"Error pre-warming announcement '{text}': {e}")
+        prewarm_state["done"] += 1
+        
+        if not cached:
+            await asyncio.sleep(1 / PREWARM_RATE)
+    
+    prewarm_state["finished"] = time.time()
+    logger.info(f"Pre-warm complete: {prewarm_state['synthesized']} synthesized, "
+                f"{prewarm_state['failed']} failed in {prewarm_state['finished'] - prewarm_state['started']:.0f}s")
+
+def allow_user_announcement(guild_id, member_id):
+    """
+    Check a member's announcement budget and use one announcement of it.
+    Returns False if the member has exceeded USER_ANNOUNCE_RATE_LIMIT per minute.
+    """
+    global user_announcement_sweep
+    if USER_ANNOUNCE_RATE_LIMIT <= 0:
+        return True
+    
+    now = time.monotonic()
+    if now - user_announcement_sweep > 60:
+        # Forget members with no announcements in the last minute
+        user_announcement_sweep = now
+        for key in [key for key, times in user_announcement_times.items() if now - times[-1] > 60]:
+            del user_announcement_times[key]
+    
+    times = user_announcement_times.setdefault((guild_id, member_id), deque())
+    while times and now - times[0] > 60:
+        times.popleft()
+    if len(times) >= USER_ANNOUNCE_RATE_LIMIT:
+        announcement_stats["rate_limited"] += 1
+        ANNOUNCEMENTS_SUPPRESSED.labels('rate_limit').inc()
+        return False
+    times.append(now)
+    return True
+
+def cancel_pending_leave(guild_id, member_id):
+    """Cancel a held leave announcement. Returns True if one was pending."""
+    task = pending_leaves.pop((guild_id, member_id), None)
+    if task is None or task.done():
+        return False
+    task.cancel()
+    return True
+
+async def hold_leave_announcement(voice_channel, member, trace):
+    """Announce a leave after FLAP_HOLD_DOWN seconds unless the member rejoins first."""
+    key = (member.guild.id, member.id)
+    try:
+        await asyncio.sleep(FLAP_HOLD_DOWN)
+    except asyncio.CancelledError:
+        trace.finish("suppressed")
+        raise
+    if pending_leaves.get(key) is asyncio.current_task():
+        del pending_leaves[key]
+    await announce_leave_if_allowed(voice_channel, member, trace)
+
+async def announce_leave_if_allowed(voice_channel, member, trace):
+    """Queue a leave announcement unless the member is over their rate limit."""
+    trace.mark("policy_decided")
+    if not allow_user_announcement(member.guild.id, member.id):
+        logger.info(f"Rate limited leave announcement for {member.display_name}")
+        trace.finish("suppressed")
+        return
+    try:
+        # Create and play the leave announcement
+        await announce_user_leave(voice_channel, member.display_name, member.id, trace)
+    except Exception as e:
+        logger.error(f"Error announcing user leave: {e}")
+
 @bot.event
 async def on_voice_state_update(member, before, after):
     """
@@ -146,238 +1853,741 @@ async def on_voice_state_update(member, before, after):
     if member.id == bot.user.id:
         return
     
-    # Initialize guild in tracking dict if not present
-    if member.guild.id not in users_in_voice:
-        users_in_voice[member.guild.id] = set()
+    VOICE_EVENTS.inc()
+    get_shard_health(member.guild.shard_id)["events"] += 1
+    if event_recorder is not None:
+        record_voice_event(member, before, after)
+    trace = AnnouncementTrace(member.guild.id)
+    trace.mark("event_received")
+    
+    guild_id = member.guild.id
+    
+    # Initialize guild presence on its first event if it was not built yet
+    if ensure_guild_presence(member.guild):
+        # The member cache already reflects this event; rewind it for this member
+        if before.channel is not None:
+            voice_presence.join(guild_id, member.id, before.channel.id)
+        else:
+            voice_presence.leave(guild_id, member.id)
     
     # Check if the member has joined a new voice channel
     if before.channel != after.channel and after.channel is not None:
-        # Check if this is a new join (not just moving between channels in the same guild)
-        is_new_join = before.channel is None or member.id not in users_in_voice[member.guild.id]
-        
-        # Add user to our tracking set
-        users_in_voice[member.guild.id].add(member.id)
+        # Record the member in their new channel. It is a new join if they were
+        # not in voice; a move between channels in the same guild is not announced.
+        previous_channel = voice_presence.join(guild_id, member.id, after.channel.id)
+        is_new_join = before.channel is None or previous_channel is None
         
         # If this is a new join, announce it
         if is_new_join:
             logger.info(f"User {member.display_name} joined {after.channel.name}")
             
+            # A quick rejoin cancels the held leave announcement and is not announced either
+            if cancel_pending_leave(guild_id, member.id):
+                logger.info(f"Suppressed flapping leave/rejoin of {member.display_name}")
+                announcement_stats["flaps"] += 1
+                ANNOUNCEMENTS_SUPPRESSED.labels('flap').inc()
+                trace.finish("suppressed")
+            
             # Only announce joins if the feature is enabled and user is in whitelist if whitelist mode is on
-            if ANNOUNCE_JOINS and (not WHITELIST_MODE or str(member.id) in announcement_whitelist):
-                try:
-                    # Create and play the announcement
-                    await announce_user_join(after.channel, member.display_name)
-                except Exception as e:
-                    logger.error(f"Error announcing user join: {e}")
+            elif ANNOUNCE_JOINS and (not WHITELIST_MODE or get_announcement_profile(member.id)["whitelisted"]):
+                trace.mark("policy_decided")
+                if not allow_user_announcement(guild_id, member.id):
+                    logger.info(f"Rate limited join announcement for {member.display_name}")
+                    trace.finish("suppressed")
+                else:
+                    try:
+                        # Create and play the announcement
+                        await announce_user_join(after.channel, member.display_name, member.id, trace)
+                    except Exception as e:
+                        logger.error(f"Error announcing user join: {e}")
     
     # Handle user leaving voice channels
     if after.channel is None and before.channel is not None:
         # User left voice channel
-        if member.id in users_in_voice[member.guild.id]:
+        if voice_presence.leave(guild_id, member.id) is not None:
             logger.info(f"User {member.display_name} left {before.channel.name}")
             
             # Announce the leave if enabled and user is in whitelist if whitelist mode is on
-            if ANNOUNCE_LEAVES and (not WHITELIST_MODE or str(member.id) in announcement_whitelist):
-                try:
-                    # Create and play the leave announcement
-                    await announce_user_leave(before.channel, member.display_name)
-                except Exception as e:
-                    logger.error(f"Error announcing user leave: {e}")
-            
-            # Remove user from tracking
-            users_in_voice[member.guild.id].remove(member.id)
+            if ANNOUNCE_LEAVES and (not WHITELIST_MODE or get_announcement_profile(member.id)["whitelisted"]):
+                if FLAP_HOLD_DOWN > 0:
+                    # Hold the announcement in case this is a flapping connection
+                    cancel_pending_leave(guild_id, member.id)
+                    pending_leaves[(guild_id, member.id)] = asyncio.create_task(
+                        hold_leave_announcement(before.channel, member, trace)
+                    )
+                else:
+                    await announce_leave_if_allowed(before.channel, member, trace)
+
+def synthesize_tts(text, language, path):
+    """Synthesize text to an audio file with the configured backend. Blocking; runs on the TTS executor."""
+    start = time.perf_counter()
+    try:
+        tts_backend.synthesize(text, language, path)
+    except Exception:
+        tts_backend.record(time.perf_counter() - start, False)
+        raise
+    duration = time.perf_counter() - start
+    tts_backend.record(duration, True)
+    TTS_SYNTHESIS_SECONDS.labels(tts_backend.name).observe(duration)
+
+def stream_tts(text, stream, cache_path=None):
+    """
+    Feed audio from the TTS backend into a stream, and into cache_path if
+    given. Returns True if the whole clip was produced. Blocking.
+    """
+    start = time.perf_counter()
+    cache_file = open(cache_path, 'wb') if cache_path else None
+    chunks = tts_backend.stream(text, VOICE_LANGUAGE)
+    try:
+        for chunk in chunks:
+            if stream.stopped:
+                return False
+            stream.write(chunk)
+            if cache_file:
+                cache_file.write(chunk)
+    except Exception as e:
+        tts_backend.record(time.perf_counter() - start, False)
+        stream.close(e)
+        raise
+    finally:
+        chunks.close()
+        if cache_file:
+            cache_file.close()
+    duration = time.perf_counter() - start
+    tts_backend.record(duration, True)
+    TTS_SYNTHESIS_SECONDS.labels(tts_backend.name).observe(duration)
+    stream.close()
+    return True
+
+async def run_tts_job(text, path, guild_id=None, priority=PRIORITY_LIVE, key=None):
+    """
+    Run a synthesis job through the TTS scheduler with a timeout.
+    If the job times out or is cancelled, the partially written file is
+    removed once the worker thread lets go of it.
+    """
+    abandoned = threading.Event()
+    
+    def remove_partial_file():
+        try:
+            if os.path.exists(path):
+                os.unlink(path)
+        except OSError as remove_error:
+            logger.error(f"Error removing partial TTS file: {remove_error}")
+    
+    def job():
+        try:
+            synthesize_tts(text, VOICE_LANGUAGE, path)
+        finally:
+            if abandoned.is_set():
+                remove_partial_file()
+    
+    try:
+        await asyncio.wait_for(tts_scheduler.submit(job, guild_id=guild_id, priority=priority, key=key), timeout=TTS_TIMEOUT)
+    except BaseException as e:
+        abandoned.set()
+        remove_partial_file()
+        if isinstance(e, asyncio.TimeoutError):
+            raise TimeoutError(f"TTS synthesis timed out after {TTS_TIMEOUT}s")
+        raise
 
-async def generate_tts_file(text):
-    """Generate a TTS audio file from text."""
+async def synthesize_to_cache(text, key, guild_id, priority):
+    """Synthesize text into the TTS cache and return the cached path."""
+    temp_path = tts_cache.new_temp_path()
+    try:
+        await run_tts_job(text, temp_path, guild_id, priority, key)
+        return tts_cache.put(key, temp_path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.unlink(temp_path)
+        raise
+
+async def generate_tts_file(text, guild_id=None, priority=PRIORITY_LIVE):
+    """
+    Generate a TTS audio file from text.
+    Repeated announcements are served from the TTS cache without synthesis,
+    and concurrent requests for the same text share a single synthesis job.
+    """
     try:
+        if TTS_CACHE_ENABLED:
+            key = TTSCache.make_key(text, VOICE_LANGUAGE, TTS_BACKEND)
+            cached_path = tts_cache.get(key)
+            if cached_path:
+                return cached_path
+            
+            # Join an identical synthesis that is already running, raising
+            # its priority if it is still waiting as a pre-warm job
+            job = pending_tts_jobs.get(key)
+            if job is not None:
+                tts_scheduler.promote(key, priority, guild_id)
+            else:
+                task = asyncio.create_task(synthesize_to_cache(text, key, guild_id, priority))
+                task.add_done_callback(lambda task: pending_tts_jobs.pop(key, None))
+                job = pending_tts_jobs[key] = SharedSynthesis(task)
+            return await job.wait()
+        
         # Create a temporary file for the TTS audio
         temp_file = tempfile.NamedTemporaryFile(delete=False, suffix='.mp3')
         temp_file.close()
         
         # Generate TTS audio
-        tts = gTTS(text=text, lang=VOICE_LANGUAGE, slow=False)
-        tts.save(temp_file.name)
+        try:
+            await run_tts_job(text, temp_file.name, guild_id, priority)
+        except BaseException:
+            if os.path.exists(temp_file.name):
+                os.unlink(temp_file.name)
+            raise
         
         return temp_file.name
     except Exception as e:
         logger.error(f"Error generating TTS: {e}")
         raise
 
-async def announce_user_join(voice_channel, username):
-    """Join a voice channel and play a TTS announcement."""
-    guild_id = voice_channel.guild.id
+async def generate_announcement_file(text, parts=None, guild_id=None, priority=PRIORITY_LIVE):
+    """
+    Return an audio file for an announcement. Default announcements, given
+    as (subject, suffix) parts, are composed from a clip of the name and a
+    shared clip of the suffix, so a new user only costs one short synthesis.
+    The composed clip is stored in the TTS cache under the full text.
+    """
+    if not (parts and PHRASE_COMPOSITION_ENABLED and TTS_CACHE_ENABLED):
+        return await generate_tts_file(text, guild_id, priority)
+    
+    key = TTSCache.make_key(text, VOICE_LANGUAGE, TTS_BACKEND)
+    cached_path = tts_cache.get(key)
+    if cached_path:
+        return cached_path
     
     try:
-        # Check for custom announcement
-        announcement_text = ""
-        
-        # Get custom join message if available
-        user_id = None
-        for member in voice_channel.members:
-            if member.display_name.lower() == username.lower():
-                user_id = str(member.id)
-                break
-        
-        if user_id and user_id in custom_announcements["users"]:
-            custom_msg = custom_announcements["users"][user_id].get("join_message")
-            if custom_msg:
-                announcement_text = custom_msg.format(username=username)
-                logger.info(f"Using custom join message for {username}")
-        
-        # Use default if no custom message
-        if not announcement_text:
-            announcement_text = f"{username} joined the channel"
-            
-        tts_file = await generate_tts_file(announcement_text)
-        
-        # Connect to the voice channel
-        voice_client = await connect_to_voice_channel(voice_channel)
-        if not voice_client:
-            logger.error("Failed to connect to voice channel")
-            if os.path.exists(tts_file):
-                os.unlink(tts_file)
-            return
-        
-        # Play the announcement
-        if os.path.exists(tts_file):
-            audio_source = discord.FFmpegPCMAudio(tts_file)
-            
-            # Play the audio
-            def after_callback(error):
-                asyncio.run_coroutine_threadsafe(
-                    handle_after_play(guild_id, tts_file, error), 
-                    bot.loop
-                )
-            
-            voice_client.play(audio_source, after=after_callback)
-        else:
-            logger.error(f"TTS file not found: {tts_file}")
-            
+        subject_file, suffix_file = await asyncio.gather(*(generate_tts_file(part, guild_id, priority) for part in parts))
+        temp_path = tts_cache.new_temp_path()
+        try:
+            await asyncio.get_running_loop().run_in_executor(audio_executor, compose_phrase, subject_file, suffix_file, temp_path)
+            return tts_cache.put(key, temp_path)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.unlink(temp_path)
+            raise
     except Exception as e:
-        logger.error(f"Error in announce_user_join: {e}")
-        # Try to clean up resources
-        if guild_id in active_voice_clients:
+        logger.warning(f"Error composing announcement, synthesizing full text instead: {e}")
+        return await generate_tts_file(text, guild_id, priority)
+
+async def stream_announcement_audio(text, guild_id=None):
+    """
+    Start synthesizing an announcement into an in-memory stream and return
+    the stream as soon as its first audio has arrived, so playback overlaps
+    synthesis. The complete clip is added to the TTS cache in the background.
+    """
+    stream = TTSStream(text)
+    key = TTSCache.make_key(text, VOICE_LANGUAGE, TTS_BACKEND) if TTS_CACHE_ENABLED else None
+    cache_path = tts_cache.new_temp_path() if key else None
+    stream.job = tts_scheduler.submit(stream_tts, text, stream, cache_path, guild_id=guild_id)
+    
+    # Other requests for the same text wait for the cached clip instead of synthesizing it again
+    cached = None
+    if key:
+        cached = asyncio.get_running_loop().create_future()
+        shared = stream.shared = pending_tts_jobs[key] = SharedSynthesis(cached)
+        cached.add_done_callback(lambda _: pending_tts_jobs.pop(key) if pending_tts_jobs.get(key) is shared else None)
+    
+    def finished(job):
+        error = None if job.cancelled() else job.exception()
+        path = None
+        if job.cancelled() or error is not None or not job.result():
+            stream.close(error)
+            if cache_path and os.path.exists(cache_path):
+                os.unlink(cache_path)
+        elif cache_path:
             try:
-                await active_voice_clients[guild_id].disconnect()
-                del active_voice_clients[guild_id]
-            except Exception as disconnect_error:
-                logger.error(f"Error disconnecting: {disconnect_error}")
+                path = tts_cache.put(key, cache_path)
+            except OSError as e:
+                logger.error(f"Error caching streamed TTS audio: {e}")
+                error = e
+        if cached is not None and not cached.done():
+            if path:
+                cached.set_result(path)
+            else:
+                cached.set_exception(error or RuntimeError("TTS synthesis cancelled"))
+                # Mark the exception as retrieved when nobody was waiting
+                cached.exception()
+    
+    stream.job.add_done_callback(finished)
+    try:
+        await asyncio.wait_for(asyncio.shield(stream.first_audio), timeout=TTS_TIMEOUT)
+    except BaseException as e:
+        stream.cancel()
+        if isinstance(e, asyncio.TimeoutError):
+            raise TimeoutError(f"No TTS audio after {TTS_TIMEOUT}s")
+        raise
+    return stream
 
-async def announce_user_leave(voice_channel, username):
-    """Join a voice channel and play a TTS announcement for a user leaving."""
-    guild_id = voice_channel.guild.id
+async def prepare_announcement_audio(text, parts=None, trace=None, priority=PRIORITY_LIVE):
+    """
+    Synthesize an announcement and, for cached clips, have its Opus frames
+    ready so playback does not need to start FFmpeg. Uncached live
+    announcements that are not composed from clips are streamed instead.
+    """
+    guild_id = trace.guild_id if trace is not None else None
+    key = TTSCache.make_key(text, VOICE_LANGUAGE, TTS_BACKEND)
+    cached = TTS_CACHE_ENABLED and tts_cache.contains(key)
+    composed = parts and PHRASE_COMPOSITION_ENABLED and TTS_CACHE_ENABLED
+    if (TTS_STREAMING_ENABLED and tts_backend.streaming and priority == PRIORITY_LIVE
+            and not cached and not composed and key not in pending_tts_jobs):
+        stream = await stream_announcement_audio(text, guild_id)
+        if trace is not None:
+            trace.mark("tts_first_audio")
+        return stream
     
+    tts_file = await generate_announcement_file(text, parts, guild_id, priority)
+    if OPUS_PRECODE_ENABLED and TTS_CACHE_ENABLED and tts_cache.contains_path(tts_file):
+        try:
+            # Frames already in memory need no worker at all
+            if cached_opus_frames(tts_file) is None:
+                await asyncio.get_running_loop().run_in_executor(audio_executor, load_opus_frames, tts_file)
+        except Exception as e:
+            logger.error(f"Error pre-encoding announcement audio, falling back to FFmpeg: {e}")
+    if trace is not None:
+        trace.mark("cache_hit" if cached else "tts_done")
+    return tts_file
+
+def create_audio_source(tts_file):
+    """Return a pre-encoded Opus source for the clip if available, otherwise an FFmpeg source."""
+    if isinstance(tts_file, TTSStream):
+        return discord.FFmpegPCMAudio(tts_file, pipe=True)
+    if OPUS_PRECODE_ENABLED:
+        frames = cached_opus_frames(tts_file)
+        if frames:
+            return OpusFrameSource(frames)
+    return discord.FFmpegPCMAudio(tts_file)
+
+async def announce_user_join(voice_channel, username, user_id=None, trace=None):
+    """Queue a TTS announcement for a user joining a voice channel."""
     try:
-        # Check for custom announcement
+        # Get custom join message if available
         announcement_text = ""
+        custom_msg = get_announcement_profile(user_id)["join_message"] if user_id else None
+        if custom_msg:
+            announcement_text = custom_msg.format(username=username)
+            logger.info(f"Using custom join message for {username}")
         
-        # Try to find user ID by username
-        user_id = None
-        for guild in bot.guilds:
-            for member in guild.members:
-                if member.display_name.lower() == username.lower():
-                    user_id = str(member.id)
-                    break
-            if user_id:
-                break
-                
+        if announcement_text:
+            enqueue_announcement(voice_channel, announcement_text, trace=trace)
+        else:
+            # Use default if no custom message
+            coalesce_announcement(voice_channel, username, "joined", trace)
+    except Exception as e:
+        ERRORS.labels('announce').inc()
+        logger.error(f"Error in announce_user_join: {e}")
+
+async def announce_user_leave(voice_channel, username, user_id=None, trace=None):
+    """Queue a TTS announcement for a user leaving a voice channel."""
+    try:
         # Get custom leave message if available
-        if user_id and user_id in custom_announcements["users"]:
-            custom_msg = custom_announcements["users"][user_id].get("leave_message")
-            if custom_msg:
-                announcement_text = custom_msg.format(username=username)
-                logger.info(f"Using custom leave message for {username}")
-        
-        # Use default if no custom message
-        if not announcement_text:
-            announcement_text = f"{username} left the channel"
-            
-        tts_file = await generate_tts_file(announcement_text)
-        
-        # Connect to the voice channel
-        voice_client = await connect_to_voice_channel(voice_channel)
-        if not voice_client:
-            logger.error("Failed to connect to voice channel")
-            if os.path.exists(tts_file):
-                os.unlink(tts_file)
-            return
+        announcement_text = ""
+        custom_msg = get_announcement_profile(user_id)["leave_message"] if user_id else None
+        if custom_msg:
+            announcement_text = custom_msg.format(username=username)
+            logger.info(f"Using custom leave message for {username}")
         
-        # Play the announcement
-        if os.path.exists(tts_file):
-            audio_source = discord.FFmpegPCMAudio(tts_file)
-            
-            # Play the audio
-            def after_callback(error):
-                asyncio.run_coroutine_threadsafe(
-                    handle_after_play(guild_id, tts_file, error), 
-                    bot.loop
-                )
-            
-            voice_client.play(audio_source, after=after_callback)
+        if announcement_text:
+            enqueue_announcement(voice_channel, announcement_text, trace=trace)
         else:
-            logger.error(f"TTS file not found: {tts_file}")
-            
+            # Use default if no custom message
+            coalesce_announcement(voice_channel, username, "left", trace)
     except Exception as e:
+        ERRORS.labels('announce').inc()
         logger.error(f"Error in announce_user_leave: {e}")
-        # Try to clean up resources
-        if guild_id in active_voice_clients:
-            try:
-                await active_voice_clients[guild_id].disconnect()
-                del active_voice_clients[guild_id]
-            except Exception as disconnect_error:
-                logger.error(f"Error disconnecting: {disconnect_error}")
+
+def default_announcement_parts(names, action):
+    """
+    Build the (subject, suffix) parts of the default announcement for one or more users.
+    e.g. ("Alice", "joined the channel"), ("Alice, Bob and 8 others", "joined the channel")
+    """
+    if len(names) == 1:
+        subject = names[0]
+    elif len(names) <= 3:
+        subject = f"{', '.join(names[:-1])} and {names[-1]}"
+    else:
+        subject = f"{names[0]}, {names[1]} and {len(names) - 2} others"
+    return subject, f"{action} the channel"
+
+def coalesce_announcement(voice_channel, username, action, trace=None):
+    """
+    Queue a default announcement right away when its guild has nothing
+    playing. While an announcement is playing, default announcements for the
+    same channel and action that arrive within ANNOUNCE_COALESCE_WINDOW
+    seconds are collected and queued as one utterance. The burst keeps the
+    trace of its first event.
+    """
+    key = (voice_channel.id, action)
+    burst = pending_bursts.get(key)
+    if burst is not None:
+        burst["names"].append(username)
+        return
+    
+    worker = playback_workers.get(voice_channel.guild.id)
+    if ANNOUNCE_COALESCE_WINDOW <= 0 or worker is None or worker.done():
+        enqueue_default_announcement(voice_channel, [username], action, trace)
+        return
+    
+    pending_bursts[key] = {"names": [username], "trace": trace}
+    asyncio.create_task(flush_burst(voice_channel, action))
+
+async def flush_burst(voice_channel, action):
+    """Wait for the coalescing window to close, then queue the combined announcement."""
+    key = (voice_channel.id, action)
+    try:
+        await asyncio.sleep(ANNOUNCE_COALESCE_WINDOW)
+    finally:
+        burst = pending_bursts.pop(key, None)
+    
+    if burst is None:
+        return
+    names = burst["names"]
+    if len(names) > 1:
+        logger.info(f"Coalesced {len(names)} {action} events in {voice_channel.name}")
+        announcement_stats["coalesced"] += len(names) - 1
+        ANNOUNCEMENTS_COALESCED.inc(len(names) - 1)
+    if names:
+        enqueue_default_announcement(voice_channel, names, action, burst["trace"])
+
+def enqueue_default_announcement(voice_channel, names, action, trace=None):
+    """Queue the default announcement for one or more users."""
+    parts = default_announcement_parts(names, action)
+    enqueue_announcement(voice_channel, " ".join(parts), parts, trace)
+
+# Stages an announcement passes through, in order. Only one of tts_done,
+# cache_hit and tts_first_audio (streamed synthesis) is recorded.
+TRACE_STAGES = ("event_received", "policy_decided", "text_rendered", "dequeued", "tts_done", "cache_hit",
+                "tts_first_audio", "voice_connected", "playback_started", "playback_finished")
+
+TRACE_STAGE_LABELS = {
+    "policy_decided": "Policy (incl. flap hold)", "text_rendered": "Text (incl. coalescing)", "dequeued": "Queue wait",
+    "tts_done": "TTS synthesis", "cache_hit": "Cache hit", "tts_first_audio": "TTS first audio (streamed)", "voice_connected": "Voice connect",
+    "playback_started": "Playback start", "playback_finished": "Playback", "total": "Event to audio"
+}
+
+@dataclass
+class AnnouncementTrace:
+    """Monotonic timestamps of the stages of one announcement."""
+    guild_id: int
+    trace_id: str = field(default_factory=lambda: uuid.uuid4().hex[:16])
+    stages: dict = field(default_factory=dict)
+    text: str = None
+    outcome: str = None
+
+    def mark(self, stage, when=None):
+        """Record the time a stage was reached."""
+        self.stages[stage] = when if when is not None else time.monotonic()
+
+    def durations(self):
+        """
+        Return seconds spent in each recorded stage, measured from the latest
+        earlier stage. Stages that overlap (synthesis runs while the
+        announcement waits in the queue) count only the time they added.
+        """
+        durations = {}
+        previous = None
+        for stage in TRACE_STAGES:
+            when = self.stages.get(stage)
+            if when is None:
+                continue
+            if previous is not None:
+                durations[stage] = max(0.0, when - previous)
+            previous = when if previous is None else max(previous, when)
+        return durations
+
+    def finish(self, outcome):
+        """Store the trace in the ring buffer and emit it as a JSON log line."""
+        if self.outcome is not None:
+            return
+        self.outcome = outcome
+        announcement_traces.append(self)
+        if TRACE_LOG_ENABLED:
+            start = min(self.stages.values()) if self.stages else 0.0
+            trace_logger.info(json.dumps({
+                "trace_id": self.trace_id,
+                "guild_id": self.guild_id,
+                "text": self.text,
+                "outcome": outcome,
+                "stages_ms": {stage: round((when - start) * 1000, 1) for stage, when in self.stages.items()},
+                "durations_ms": {stage: round(duration * 1000, 1) for stage, duration in self.durations().items()}
+            }))
+
+@dataclass
+class Announcement:
+    """A queued announcement waiting to be played in a guild."""
+    voice_channel: discord.abc.Connectable
+    text: str
+    created: float = field(default_factory=time.monotonic)
+    audio_task: asyncio.Task = None
+    trace: AnnouncementTrace = None
+
+def enqueue_announcement(voice_channel, text, parts=None, trace=None):
+    """
+    Add an announcement to its guild's playback queue and make sure a
+    playback worker is running. Synthesis starts immediately so it overlaps
+    with whatever is currently playing. When the queue is full the oldest
+    pending announcement is dropped.
+    """
+    guild_id = voice_channel.guild.id
+    queue = announcement_queues.get(guild_id)
+    if queue is None:
+        queue = announcement_queues[guild_id] = asyncio.Queue(maxsize=ANNOUNCE_QUEUE_MAX)
+    
+    trace = trace or AnnouncementTrace(guild_id)
+    trace.text = text
+    trace.mark("text_rendered")
+    
+    if queue.full():
+        dropped = queue.get_nowait()
+        discard_announcement(dropped)
+        dropped.trace.finish("dropped")
+        announcement_stats["dropped"] += 1
+        ANNOUNCEMENTS_DROPPED.labels('queue_full').inc()
+        logger.warning(f"Announcement queue full in guild {guild_id}, dropped: '{dropped.text}'")
+    
+    announcement = Announcement(voice_channel=voice_channel, text=text, trace=trace)
+    announcement.audio_task = asyncio.create_task(prepare_announcement_audio(text, parts, trace))
+    queue.put_nowait(announcement)
+    QUEUE_DEPTH.labels(str(guild_id)).set(queue.qsize())
+    
+    worker = playback_workers.get(guild_id)
+    if worker is None or worker.done():
+        playback_workers[guild_id] = asyncio.create_task(playback_worker(guild_id))
+
+def discard_announcement(announcement):
+    """Cancel or clean up the audio of an announcement that will not be played."""
+    task = announcement.audio_task
+    if task is None:
+        return
+    if not task.done():
+        task.cancel()
+    elif not task.cancelled() and task.exception() is None:
+        discard_tts_file(task.result())
+
+async def playback_worker(guild_id):
+    """
+    Play the queued announcements of one guild in order, one at a time.
+    The worker exits when the queue is empty and is restarted on demand.
+    """
+    queue = announcement_queues[guild_id]
+    while True:
+        try:
+            announcement = queue.get_nowait()
+        except asyncio.QueueEmpty:
+            break
+        QUEUE_DEPTH.labels(str(guild_id)).set(queue.qsize())
+        announcement.trace.mark("dequeued")
+        
+        try:
+            await play_announcement(guild_id, announcement)
+        except Exception as e:
+            ERRORS.labels('playback').inc()
+            logger.error(f"Error playing announcement in guild {guild_id}: {e}")
+            discard_announcement(announcement)
+            announcement.trace.finish("failed")
+            # Anything left is a voice error; reconnect from scratch next time
+            if guild_id in active_voice_clients:
+                try:
+                    await disconnect_voice_client(guild_id)
+                except Exception as disconnect_error:
+                    logger.error(f"Error disconnecting: {disconnect_error}")
+
+def is_stale(announcement):
+    """Return True if an announcement has waited too long to be worth playing."""
+    return time.monotonic() - announcement.created > ANNOUNCE_MAX_AGE
+
+async def play_announcement(guild_id, announcement):
+    """Connect to the announcement's channel and play it to completion."""
+    if is_stale(announcement):
+        logger.info(f"Skipping stale announcement: '{announcement.text}'")
+        announcement_stats["expired"] += 1
+        ANNOUNCEMENTS_DROPPED.labels('expired').inc()
+        discard_announcement(announcement)
+        announcement.trace.finish("expired")
+        return
+    
+    # A failed synthesis only loses this announcement; the voice connection stays warm
+    try:
+        tts_file = await announcement.audio_task
+    except Exception as e:
+        ERRORS.labels('tts').inc()
+        logger.error(f"Error preparing announcement audio for '{announcement.text}': {e}")
+        announcement.trace.finish("failed")
+        return
+    
+    # Synthesis may have taken long enough for the announcement to go stale
+    if is_stale(announcement):
+        logger.info(f"Skipping stale announcement: '{announcement.text}'")
+        announcement_stats["expired"] += 1
+        ANNOUNCEMENTS_DROPPED.labels('expired').inc()
+        discard_tts_file(tts_file)
+        announcement.trace.finish("expired")
+        return
+    
+    # Connect to the voice channel
+    voice_client = await connect_to_voice_channel(announcement.voice_channel)
+    if not voice_client:
+        logger.error("Failed to connect to voice channel")
+        discard_tts_file(tts_file)
+        announcement.trace.finish("failed")
+        return
+    announcement.trace.mark("voice_connected")
+    
+    # Play the announcement
+    if isinstance(tts_file, str) and not os.path.exists(tts_file):
+        logger.error(f"TTS file not found: {tts_file}")
+        announcement.trace.finish("failed")
+        return
+    
+    try:
+        audio_source = create_audio_source(tts_file)
+    except Exception as e:
+        ERRORS.labels('playback').inc()
+        logger.error(f"Error creating audio source: {e}")
+        discard_tts_file(tts_file)
+        announcement.trace.finish("failed")
+        return
+    loop = asyncio.get_running_loop()
+    finished = asyncio.Event()
+    
+    # Play the audio
+    def after_callback(error):
+        asyncio.run_coroutine_threadsafe(
+            handle_after_play(guild_id, tts_file, error), 
+            loop
+        )
+        loop.call_soon_threadsafe(finished.set)
+    
+    voice_client.play(audio_source, after=after_callback)
+    started = time.monotonic()
+    announcement.trace.mark("playback_started", started)
+    EVENT_TO_AUDIO_SECONDS.observe(started - announcement.trace.stages.get("event_received", announcement.created))
+    await finished.wait()
+    announcement.trace.mark("playback_finished")
+    PLAYBACK_SECONDS.observe(announcement.trace.stages["playback_finished"] - started)
+    announcement_stats["played"] += 1
+    ANNOUNCEMENTS_PLAYED.inc()
+    announcement.trace.finish("played")
 
 async def connect_to_voice_channel(voice_channel):
-    """Connect to a voice channel, handling any existing connections."""
+    """
+    Connect to a voice channel, reusing the guild's warm connection if there
+    is one. Connections in the same guild are moved between channels rather
+    than torn down and re-established.
+    """
     guild_id = voice_channel.guild.id
     
+    # Playback is about to start; stop any pending idle disconnect
+    cancel_idle_disconnect(guild_id)
+    health = voice_health.setdefault(guild_id, {"connects": 0, "moves": 0, "failures": 0, "last_used": None})
+    health["last_used"] = time.time()
+    
     try:
         # Check if bot is already connected to a voice channel in this guild
-        if guild_id in active_voice_clients:
-            voice_client = active_voice_clients[guild_id]
-            
-            # If already connected to the target channel, use that connection
-            if voice_client.is_connected() and voice_client.channel.id == voice_channel.id:
+        voice_client = active_voice_clients.get(guild_id) or voice_channel.guild.voice_client
+        if voice_client is not None:
+            if voice_client.is_connected():
+                # If already connected to the target channel, use that connection
+                if voice_client.channel.id == voice_channel.id:
+                    active_voice_clients[guild_id] = voice_client
+                    return voice_client
+                
+                # If connected to a different channel, move without a new handshake
+                with VOICE_CONNECT_SECONDS.labels('move').time():
+                    await voice_client.move_to(voice_channel)
+                active_voice_clients[guild_id] = voice_client
+                health["moves"] += 1
                 return voice_client
             
-            # If connected to a different channel, disconnect first
-            if voice_client.is_connected():
-                await voice_client.disconnect()
-                # Wait a brief moment to ensure the disconnect completes
-                await asyncio.sleep(0.5)
+            # Stale connection; clean it up before reconnecting
+            await disconnect_voice_client(guild_id, voice_client)
         
         # Connect to the voice channel
-        voice_client = await voice_channel.connect(timeout=10, reconnect=True)
+        with VOICE_CONNECT_SECONDS.labels('connect').time():
+            voice_client = await voice_channel.connect(timeout=10, reconnect=True)
         active_voice_clients[guild_id] = voice_client
+        health["connects"] += 1
         return voice_client
     except Exception as e:
+        health["failures"] += 1
+        ERRORS.labels('voice_connect').inc()
         logger.error(f"Error connecting to voice channel: {e}")
         return None
 
-async def handle_after_play(guild_id, tts_file, error):
-    """Handle cleanup after playing an announcement."""
-    # Delete the temporary TTS file
+async def disconnect_voice_client(guild_id, voice_client=None):
+    """Disconnect and forget the voice connection of a guild."""
+    voice_client = voice_client or active_voice_clients.get(guild_id)
+    active_voice_clients.pop(guild_id, None)
+    cancel_idle_disconnect(guild_id)
+    if voice_client is not None:
+        await voice_client.disconnect(force=True)
+
+def cancel_idle_disconnect(guild_id):
+    """Cancel a pending idle disconnect for a guild, if any."""
+    task = idle_disconnect_tasks.pop(guild_id, None)
+    if task is not None and not task.done() and task is not asyncio.current_task():
+        task.cancel()
+
+def schedule_idle_disconnect(guild_id, delay):
+    """(Re)start the timer that closes a guild's voice connection once it is idle."""
+    cancel_idle_disconnect(guild_id)
+    idle_disconnect_tasks[guild_id] = asyncio.create_task(idle_disconnect(guild_id, delay))
+
+async def idle_disconnect(guild_id, delay):
+    """Disconnect from voice after the connection has been idle for a while."""
+    try:
+        await asyncio.sleep(delay)
+        
+        # More announcements are on the way; keep the connection open
+        worker = playback_workers.get(guild_id)
+        if worker is not None and not worker.done():
+            return
+        
+        voice_client = active_voice_clients.get(guild_id)
+        if voice_client and voice_client.is_connected() and not voice_client.is_playing():
+            logger.info(f"Closing idle voice connection in guild {guild_id}")
+            idle_disconnect_tasks.pop(guild_id, None)
+            await disconnect_voice_client(guild_id, voice_client)
+    except asyncio.CancelledError:
+        pass
+    except Exception as e:
+        logger.error(f"Error closing idle voice connection: {e}")
+
+def discard_tts_file(tts_file):
+    """Delete a TTS file after use unless it belongs to the TTS cache."""
+    if isinstance(tts_file, TTSStream):
+        # Stops synthesis if playback ended before the stream did
+        tts_file.cancel()
+        return
     try:
+        if TTS_CACHE_ENABLED and tts_cache.contains_path(tts_file):
+            return
         if os.path.exists(tts_file):
             os.unlink(tts_file)
     except Exception as e:
         logger.error(f"Error deleting TTS file: {e}")
+
+async def handle_after_play(guild_id, tts_file, error):
+    """Handle cleanup after playing an announcement."""
+    # Delete the temporary TTS file
+    discard_tts_file(tts_file)
     
-    # Disconnect from voice channel after a delay
+    # Keep the connection warm for the next announcement, unless nobody is
+    # left in the channel to hear it
     try:
-        # Wait a moment before disconnecting
-        await asyncio.sleep(1)
-        
-        if guild_id in active_voice_clients:
-            voice_client = active_voice_clients[guild_id]
-            if voice_client and voice_client.is_connected() and not voice_client.is_playing():
-                await voice_client.disconnect()
-                del active_voice_clients[guild_id]
+        voice_client = active_voice_clients.get(guild_id)
+        if voice_client and voice_client.is_connected():
+            if any(not member.bot for member in voice_client.channel.members):
+                schedule_idle_disconnect(guild_id, VOICE_IDLE_TIMEOUT)
+            else:
+                schedule_idle_disconnect(guild_id, 1)
     except Exception as e:
         logger.error(f"Error in handle_after_play: {e}")
     
     # Log any error that occurred during playback
     if error:
+        ERRORS.labels('playback').inc()
         logger.error(f"Error in voice playback: {error}")
 
 # Command for testing announcement functionality
@@ -392,7 +2602,7 @@ async def test_announce(ctx, *, message=None):
     username = message or ctx.author.display_name
     
     await ctx.send(f"Testing announcement system with: '{username}'")
-    await announce_user_join(voice_channel, username)
+    await announce_user_join(voice_channel, username, None if message else ctx.author.id)
 
 # Command to show bot info and status
 @bot.command(name='status', help='Show bot status and configuration')
@@ -416,13 +2626,63 @@ async def status(ctx):
         inline=True
     )
     
+    if ctx.guild and ctx.guild.id in active_voice_clients:
+        voice_client = active_voice_clients[ctx.guild.id]
+        health = voice_health.get(ctx.guild.id, {})
+        if voice_client.is_connected():
+            idle_seconds = int(time.time() - (health.get("last_used") or time.time()))
+            health_text = (f"{voice_client.channel.name}, {voice_client.latency * 1000:.0f} ms, idle {idle_seconds}s\n"
+                           f"{health.get('connects', 0)} connects, {health.get('moves', 0)} moves, "
+                           f"{health.get('failures', 0)} failures")
+        else:
+            health_text = "Reconnecting"
+        embed.add_field(
+            name="Voice Connection", 
+            value=health_text,
+            inline=True
+        )
+    
     embed.add_field(
         name="TTS Language", 
         value=VOICE_LANGUAGE,
         inline=True
     )
     
-    tracked_users = sum(len(users) for users in users_in_voice.values())
+    backend_stats = tts_backend.stats()
+    if backend_stats["calls"]:
+        backend_text = (f"{tts_backend.name} (p50 {backend_stats['p50'] * 1000:.0f} ms, "
+                        f"p95 {backend_stats['p95'] * 1000:.0f} ms, "
+                        f"{backend_stats['calls']} calls, {backend_stats['failures']} failed, "
+                        f"{tts_scheduler.running} running, {tts_scheduler.queued()} queued)")
+    else:
+        backend_text = f"{tts_backend.name} (no calls yet)"
+    embed.add_field(
+        name="TTS Backend", 
+        value=backend_text,
+        inline=True
+    )
+    
+    if SHARDING_ENABLED:
+        guild_counts = {}
+        for guild in bot.guilds:
+            guild_counts[guild.shard_id] = guild_counts.get(guild.shard_id, 0) + 1
+        shard_lines = []
+        for shard_id in sorted(bot.shards):
+            health = get_shard_health(shard_id)
+            state = "connected" if health["connected"] else "disconnected"
+            shard_lines.append(f"{shard_id}: {bot.shards[shard_id].latency * 1000:.0f} ms, {state}, "
+                               f"{guild_counts.get(shard_id, 0)} servers, {health['events']} events, "
+                               f"{health['disconnects']} drops")
+        if len(shard_lines) > 10:
+            shard_lines = shard_lines[:10] + [f"... and {len(shard_lines) - 10} more"]
+        current = f" (this server: {ctx.guild.shard_id})" if ctx.guild else ""
+        embed.add_field(
+            name=f"Shards {len(bot.shards)}/{bot.shard_count}{current}", 
+            value="\n".join(shard_lines) or "Starting",
+            inline=False
+        )
+    
+    tracked_users = voice_presence.count()
     embed.add_field(
         name="Users in Voice Channels", 
         value=str(tracked_users),
@@ -441,6 +2701,30 @@ async def status(ctx):
         inline=True
     )
     
+    queued_count = sum(queue.qsize() for queue in announcement_queues.values())
+    embed.add_field(
+        name="Queued Announcements", 
+        value=f"{queued_count} ({announcement_stats['dropped']} dropped, {announcement_stats['expired']} expired)",
+        inline=True
+    )
+    
+    embed.add_field(
+        name="Suppressed Announcements", 
+        value=f"{announcement_stats['flaps']} flaps, {announcement_stats['rate_limited']} rate limited",
+        inline=True
+    )
+    
+    if prewarm_state["started"] is not None:
+        if prewarm_state["finished"] is not None:
+            prewarm_text = f"Complete ({prewarm_state['total']} clips, {prewarm_state['failed']} failed)"
+        else:
+            prewarm_text = f"{prewarm_state['done']}/{prewarm_state['total']} clips ({prewarm_state['failed']} failed)"
+        embed.add_field(
+            name="Audio Pre-warm", 
+            value=prewarm_text,
+            inline=True
+        )
+    
     custom_count = len(custom_announcements["users"]) - (1 if "_comment" in custom_announcements["users"] else 0)
     embed.add_field(
         name="Custom Announcements", 
@@ -457,30 +2741,63 @@ async def status(ctx):
     
     await ctx.send(embed=embed)
 
+@bot.command(name='perf', help='Show announcement latency per stage in this server')
+async def perf(ctx, count: int = 50):
+    """Command to show p50/p95/p99 of each announcement stage over the last N announcements."""
+    if ctx.guild is None:
+        await ctx.send("This command can only be used in a server.")
+        return
+    
+    recent = [trace for trace in announcement_traces if trace.guild_id == ctx.guild.id][-max(1, count):]
+    played = [trace for trace in recent if trace.outcome == "played"]
+    if not played:
+        await ctx.send("No announcements have been played in this server yet.")
+        return
+    
+    outcomes = {}
+    for trace in recent:
+        outcomes[trace.outcome] = outcomes.get(trace.outcome, 0) + 1
+    embed = discord.Embed(
+        title="Announcement Performance",
+        description=f"Last {len(recent)} announcements: " + ", ".join(f"{n} {outcome}" for outcome, n in sorted(outcomes.items())),
+        color=discord.Color.blue()
+    )
+    
+    stage_durations = {}
+    for trace in played:
+        for stage, duration in trace.durations().items():
+            stage_durations.setdefault(stage, []).append(duration)
+        stage_durations.setdefault("total", []).append(
+            trace.stages["playback_started"] - min(trace.stages.values())
+        )
+    
+    for stage in TRACE_STAGES + ("total",):
+        durations = sorted(stage_durations.get(stage, []))
+        if not durations:
+            continue
+        embed.add_field(
+            name=TRACE_STAGE_LABELS.get(stage, stage),
+            value=(f"p50 {percentile(durations, 0.5) * 1000:.0f} ms\n"
+                   f"p95 {percentile(durations, 0.95) * 1000:.0f} ms\n"
+                   f"p99 {percentile(durations, 0.99) * 1000:.0f} ms ({len(durations)})"),
+            inline=True
+        )
+    
+    await ctx.send(embed=embed)
+
 # Command to toggle join announcements
 @bot.command(name='togglejoins', help='Toggle join announcements on/off')
 async def toggle_joins(ctx):
     """Command to toggle whether join announcements are enabled."""
     global ANNOUNCE_JOINS
     ANNOUNCE_JOINS = not ANNOUNCE_JOINS
+    save_runtime_settings(['ANNOUNCE_JOINS'])
     
     status = "enabled" if ANNOUNCE_JOINS else "disabled"
     await ctx.send(f"Join announcements are now {status}")
     
     # Update bot presence to reflect the change
-    if ANNOUNCE_JOINS and ANNOUNCE_LEAVES:
-        activity_name = "voice channel activity"
-    elif ANNOUNCE_JOINS:
-        activity_name = "voice channel joins"
-    elif ANNOUNCE_LEAVES:
-        activity_name = "voice channel leaves"
-    else:
-        activity_name = "voice channels"
-        
-    await bot.change_presence(activity=discord.Activity(
-        type=discord.ActivityType.listening, 
-        name=activity_name
-    ))
+    await update_presence()
 
 # Command to toggle leave announcements
 @bot.command(name='toggleleaves', help='Toggle leave announcements on/off')
@@ -488,24 +2805,13 @@ async def toggle_leaves(ctx):
     """Command to toggle whether leave announcements are enabled."""
     global ANNOUNCE_LEAVES
     ANNOUNCE_LEAVES = not ANNOUNCE_LEAVES
+    save_runtime_settings(['ANNOUNCE_LEAVES'])
     
     status = "enabled" if ANNOUNCE_LEAVES else "disabled"
     await ctx.send(f"Leave announcements are now {status}")
     
     # Update bot presence to reflect the change
-    if ANNOUNCE_JOINS and ANNOUNCE_LEAVES:
-        activity_name = "voice channel activity"
-    elif ANNOUNCE_JOINS:
-        activity_name = "voice channel joins"
-    elif ANNOUNCE_LEAVES:
-        activity_name = "voice channel leaves"
-    else:
-        activity_name = "voice channels"
-        
-    await bot.change_presence(activity=discord.Activity(
-        type=discord.ActivityType.listening, 
-        name=activity_name
-    ))
+    await update_presence()
 
 # Command to toggle whitelist mode
 @bot.command(name='togglewhitelist', help='Toggle between announcing all users or only whitelisted users')
@@ -514,6 +2820,7 @@ async def toggle_whitelist(ctx):
     """Command to toggle whether announcements are for all users or only whitelisted users."""
     global WHITELIST_MODE
     WHITELIST_MODE = not WHITELIST_MODE
+    save_runtime_settings(['WHITELIST_MODE'])
     
     status = "enabled" if WHITELIST_MODE else "disabled"
     if WHITELIST_MODE and len(announcement_whitelist) == 0:
@@ -540,7 +2847,8 @@ async def whitelist_add(ctx, user: discord.Member):
         return
         
     announcement_whitelist.add(user_id)
-    save_whitelist()
+    update_announcement_profile(user_id)
+    save_whitelist_user(user_id)
     
     await ctx.send(f"{user.display_name} has been added to the announcement whitelist.")
     
@@ -559,7 +2867,8 @@ async def whitelist_remove(ctx, user: discord.Member):
         return
         
     announcement_whitelist.remove(user_id)
-    save_whitelist()
+    update_announcement_profile(user_id)
+    save_whitelist_user(user_id)
     
     await ctx.send(f"{user.display_name} has been removed from the announcement whitelist.")
 
@@ -576,22 +2885,18 @@ async def whitelist_list(ctx):
         description=f"Whitelist Mode: {'Enabled' if WHITELIST_MODE else 'Disabled'}"
     )
     
-    # Get user objects for all IDs in the whitelist
+    # Resolve whitelisted IDs through the member and user caches
     whitelist_members = []
     for user_id in announcement_whitelist:
-        user = None
-        for guild in bot.guilds:
-            user = guild.get_member(int(user_id))
-            if user:
-                whitelist_members.append(user)
-                break
+        member = ctx.guild.get_member(int(user_id)) if ctx.guild else None
+        whitelist_members.append((user_id, member or bot.get_user(int(user_id))))
     
     # Sort members by name for easier reading
-    whitelist_members.sort(key=lambda m: m.display_name.lower() if m else "")
+    whitelist_members.sort(key=lambda entry: entry[1].display_name.lower() if entry[1] else "")
     
     # Create a string with all the members
     members_text = ""
-    for i, member in enumerate(whitelist_members, 1):
+    for i, (user_id, member) in enumerate(whitelist_members, 1):
         if member:
             members_text += f"{i}. {member.mention} ({member.display_name})\n"
         else:
@@ -649,9 +2954,10 @@ async def add_custom(ctx, user: discord.Member, message_type: str, *, message: s
         custom_announcements["users"][user_id]["join_message"] = message
     else:
         custom_announcements["users"][user_id]["leave_message"] = message
+    apply_announcement_change(user_id)
     
     # Save changes
-    save_custom_announcements()
+    save_custom_announcement(user_id)
     
     await ctx.send(f"Custom {message_type} message for {user.display_name} has been set!")
 
@@ -691,9 +2997,10 @@ async def remove_custom(ctx, user: discord.Member, message_type: str = "both"):
         else:
             await ctx.send(f"{user.display_name} has no custom {message_type} message")
             return
+    apply_announcement_change(user_id)
     
     # Save changes
-    save_custom_announcements()
+    save_custom_announcement(user_id)
     
     await ctx.send(f"Custom {message_info} for {user.display_name} removed!")
 
@@ -1,8 +1,14 @@
 import os
 import json
+import time
+import hashlib
 import logging
+import tempfile
+import threading
+import sqlite3
 import docker
-from flask import Flask, render_template, request, redirect, url_for, flash, jsonify
+import requests
+from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, g
 from dotenv import load_dotenv
 from werkzeug.utils import secure_filename
 
@@ -20,7 +26,16 @@ app.secret_key = os.getenv('FLASK_SECRET_KEY', 'discord-voice-announcer-secret')
 DATA_DIR = os.getenv('DATA_DIR', '/app/data')
 CUSTOM_ANNOUNCEMENTS_FILE = os.path.join(DATA_DIR, 'custom_announcements.json')
 WHITELIST_FILE = os.path.join(DATA_DIR, 'announcement_whitelist.json')
+STATE_DB_PATH = os.getenv('STATE_DB_PATH', os.path.join(DATA_DIR, 'voice_announcer.db'))
 BOT_CONTAINER_NAME = os.getenv('BOT_CONTAINER_NAME', 'discord-voice-announcer')
+BOT_ADMIN_URL = os.getenv('BOT_ADMIN_URL', f'http://{BOT_CONTAINER_NAME}:8080')
+ADMIN_API_TOKEN = os.getenv('ADMIN_API_TOKEN', '')
+
+# Seconds before the cached container inspection is refreshed
+DOCKER_CACHE_TTL = float(os.getenv('DOCKER_CACHE_TTL', '10'))
+
+# Settings the bot can apply live through its admin API, without recreating the container
+LIVE_SETTINGS = ['VOICE_LANGUAGE', 'COMMAND_PREFIX', 'ANNOUNCE_JOINS', 'ANNOUNCE_LEAVES', 'WHITELIST_MODE']
 
 # Ensure data directory exists
 os.makedirs(DATA_DIR, exist_ok=True)
@@ -33,6 +48,60 @@ except Exception as e:
     logger.error(f"Error initializing Docker client: {e}")
     docker_client = None
 
+# Cached inspection of the bot container, kept fresh by background threads
+bot_container_cache = {"env": None, "status": None, "live_settings": None, "error": None, "refreshed_at": None}
+bot_container_lock = threading.Lock()
+bot_container_refresh_requested = threading.Event()
+
+# Shared in-process read cache, validated by the (mtime, size) of the files it was read from
+read_cache = {}
+read_cache_lock = threading.Lock()
+
+def file_signature(paths):
+    """Return the (mtime, size) of each path, or None for missing files."""
+    signature = []
+    for path in paths:
+        try:
+            stat = os.stat(path)
+            signature.append((stat.st_mtime_ns, stat.st_size))
+        except OSError:
+            signature.append(None)
+    return tuple(signature)
+
+def make_etag(key, signature):
+    """Build an ETag from a cache key and the file signature it was read at."""
+    return hashlib.sha1(repr((key, signature)).encode()).hexdigest()
+
+def cached_read(key, paths, loader):
+    """
+    Return (value, etag) for a cached document, calling loader only when one
+    of the underlying files changed since the last read. Cached values are
+    shared between requests and must not be modified.
+    """
+    signature = file_signature(paths)
+    with read_cache_lock:
+        entry = read_cache.get(key)
+        if entry is not None and entry[0] == signature:
+            return entry[1], entry[2]
+    
+    # Signature taken before loading, so a concurrent write forces a re-read next time
+    value = loader()
+    etag = make_etag(key, signature)
+    with read_cache_lock:
+        read_cache[key] = (signature, value, etag)
+    return value, etag
+
+def invalidate_read_cache(key):
+    """Drop a cached document after this process changed it."""
+    with read_cache_lock:
+        read_cache.pop(key, None)
+
+def json_response_with_etag(data, etag):
+    """Return a JSON response that answers If-None-Match with 304 Not Modified."""
+    response = jsonify(data)
+    response.set_etag(etag)
+    return response.make_conditional(request)
+
 # Helper functions
 def load_json_file(file_path, default_value=None):
     """Load a JSON file or return a default value if it doesn't exist."""
@@ -41,56 +110,245 @@ def load_json_file(file_path, default_value=None):
     
     try:
         if os.path.exists(file_path):
-            with open(file_path, 'r') as f:
-                return json.load(f)
+            def read_file():
+                with open(file_path, 'r') as f:
+                    return json.load(f)
+            return cached_read(file_path, [file_path], read_file)[0]
         else:
             logger.warning(f"File not found: {file_path}, using default value")
             # Create the file with default value
-            with open(file_path, 'w') as f:
-                json.dump(default_value, f, indent=4)
+            save_json_file(file_path, default_value)
             return default_value
     except Exception as e:
         logger.error(f"Error loading JSON file {file_path}: {e}")
         return default_value
 
 def save_json_file(file_path, data):
-    """Save data to a JSON file."""
+    """Atomically save data to a JSON file by writing a temp file and renaming it into place."""
     try:
-        with open(file_path, 'w') as f:
-            json.dump(data, f, indent=4)
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(file_path) or '.', suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(data, f, indent=4)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temp_path, file_path)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.unlink(temp_path)
+            raise
+        # Write-through: the new contents become the cached value
+        signature = file_signature([file_path])
+        with read_cache_lock:
+            read_cache[file_path] = (signature, data, make_etag(file_path, signature))
         return True
     except Exception as e:
         logger.error(f"Error saving JSON file {file_path}: {e}")
         return False
 
-def get_bot_env_vars():
-    """Get environment variables from the bot container."""
-    if docker_client is None:
-        return {
-            "DISCORD_TOKEN": "Not available - Docker client not initialized",
-            "VOICE_LANGUAGE": "en",
-            "COMMAND_PREFIX": "!",
-            "ANNOUNCE_JOINS": "True",
-            "ANNOUNCE_LEAVES": "True",
-            "WHITELIST_MODE": "False",
-            "TZ": "UTC"
-        }
+# Shared SQLite state store (also used by main.py; keep the schema in sync)
+STATE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS custom_announcements (
+    user_id TEXT PRIMARY KEY,
+    display_name TEXT,
+    join_message TEXT,
+    leave_message TEXT,
+    updated_at REAL
+);
+CREATE TABLE IF NOT EXISTS whitelist (
+    user_id TEXT PRIMARY KEY,
+    added_at REAL
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+CREATE TABLE IF NOT EXISTS settings (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+def open_state_db():
+    """Open a connection to the state database in WAL mode, creating the schema if needed."""
+    conn = sqlite3.connect(STATE_DB_PATH, timeout=10)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.executescript(STATE_SCHEMA)
+    return conn
+
+def import_legacy_json(conn):
+    """One-time import of the legacy JSON data files. Existing rows are never overwritten."""
+    if conn.execute("SELECT 1 FROM meta WHERE key = 'json_imported'").fetchone():
+        return
     
+    now = time.time()
+    with conn:
+        if os.path.exists(CUSTOM_ANNOUNCEMENTS_FILE):
+            users = load_json_file(CUSTOM_ANNOUNCEMENTS_FILE, {"users": {}}).get("users", {})
+            conn.executemany(
+                "INSERT OR IGNORE INTO custom_announcements VALUES (?, ?, ?, ?, ?)",
+                [(user_id, entry.get("display_name"), entry.get("join_message"), entry.get("leave_message"), now)
+                 for user_id, entry in users.items() if user_id != "_comment" and isinstance(entry, dict)]
+            )
+        if os.path.exists(WHITELIST_FILE):
+            users = load_json_file(WHITELIST_FILE, {"users": []}).get("users", [])
+            conn.executemany("INSERT OR IGNORE INTO whitelist VALUES (?, ?)", [(str(user_id), now) for user_id in users])
+        conn.execute("INSERT OR REPLACE INTO meta VALUES ('json_imported', ?)", (str(now),))
+    logger.info("Imported legacy JSON data files into the state database")
+
+def get_db():
+    """Return the state database connection for the current request."""
+    if 'db' not in g:
+        g.db = open_state_db()
+    return g.db
+
+@app.teardown_appcontext
+def close_db(exception):
+    """Close the request's state database connection."""
+    db = g.pop('db', None)
+    if db is not None:
+        db.close()
+
+# Files whose (mtime, size) change whenever the state database is written
+STATE_DB_FILES = [STATE_DB_PATH, STATE_DB_PATH + '-wal']
+
+def load_custom_announcements():
+    """
+    Load all custom announcements in the {"users": {user_id: {...}}} shape used
+    by the templates. Returns (data, etag); served from the read cache until the database changes.
+    """
+    def query():
+        users = {}
+        for row in get_db().execute("SELECT * FROM custom_announcements ORDER BY display_name"):
+            entry = {"display_name": row["display_name"] or "Unknown User"}
+            if row["join_message"] is not None:
+                entry["join_message"] = row["join_message"]
+            if row["leave_message"] is not None:
+                entry["leave_message"] = row["leave_message"]
+            users[row["user_id"]] = entry
+        return {"users": users}
+    return cached_read('custom_announcements', STATE_DB_FILES, query)
+
+def load_whitelist():
+    """
+    Load the whitelist in the {"users": [user_id, ...]} shape used by the
+    templates. Returns (data, etag); served from the read cache until the database changes.
+    """
+    def query():
+        return {"users": [row["user_id"] for row in get_db().execute("SELECT user_id FROM whitelist ORDER BY added_at")]}
+    return cached_read('whitelist', STATE_DB_FILES, query)
+
+def call_bot_admin_api(method, path, payload=None):
+    """Call the bot's admin API. Returns the decoded response, or None if the bot could not be reached."""
+    if not ADMIN_API_TOKEN:
+        return None
+    try:
+        response = requests.request(
+            method, f"{BOT_ADMIN_URL}{path}", json=payload, timeout=3,
+            headers={"Authorization": f"Bearer {ADMIN_API_TOKEN}"}
+        )
+        response.raise_for_status()
+        return response.json()
+    except Exception as e:
+        logger.warning(f"Bot admin API call {method} {path} failed: {e}")
+        return None
+
+def save_live_settings(env_vars):
+    """
+    Store the live settings in the state database. The bot applies these on
+    startup, so they must match the environment of a recreated container.
+    """
+    try:
+        db = get_db()
+        with db:
+            db.executemany(
+                "INSERT OR REPLACE INTO settings VALUES (?, ?)",
+                [(key, str(env_vars[key])) for key in LIVE_SETTINGS if key in env_vars]
+            )
+    except Exception as e:
+        logger.error(f"Error saving live settings: {e}")
+
+def apply_bot_settings(new_env, current_env):
+    """
+    Apply changed settings to the bot. Settings the bot supports at runtime are
+    applied live through its admin API; anything else (such as the token)
+    falls back to recreating the container.
+    Returns (success, how) where how is 'unchanged', 'live' or 'recreated'.
+    """
+    changed = {key: value for key, value in new_env.items() if current_env.get(key) != value}
+    if not changed:
+        return True, 'unchanged'
+    
+    if set(changed) <= set(LIVE_SETTINGS):
+        if call_bot_admin_api('POST', '/api/settings', changed) is not None:
+            refresh_bot_container_cache()
+            return True, 'live'
+        logger.info("Bot admin API unavailable, recreating the container instead")
+    
+    save_live_settings(new_env)
+    return update_bot_env_vars(new_env), 'recreated'
+
+def refresh_bot_container_cache():
+    """Inspect the bot container and the bot's live settings, and store the result in the cache."""
     try:
         container = docker_client.containers.get(BOT_CONTAINER_NAME)
-        env_vars = {}
-        
-        # Get all environment variables from the container
-        inspect_result = container.attrs['Config']['Env']
-        for env_var in inspect_result:
+        env = {}
+        for env_var in container.attrs['Config']['Env']:
             if '=' in env_var:
                 key, value = env_var.split('=', 1)
-                if key in ['DISCORD_TOKEN', 'VOICE_LANGUAGE', 'COMMAND_PREFIX', 
-                          'ANNOUNCE_JOINS', 'ANNOUNCE_LEAVES', 'WHITELIST_MODE', 'TZ']:
-                    env_vars[key] = value
-        
-        # Fill in missing variables with defaults
-        defaults = {
+                env[key] = value
+        status = container.status
+        error = None
+    except Exception as e:
+        logger.error(f"Error inspecting bot container: {e}")
+        env, status, error = None, "unknown", str(e)
+    
+    live = call_bot_admin_api('GET', '/api/settings')
+    live_settings = live.get('settings') if live and isinstance(live.get('settings'), dict) else None
+    
+    with bot_container_lock:
+        if env is not None or bot_container_cache["env"] is None:
+            bot_container_cache["env"] = env
+        bot_container_cache.update({
+            "status": status,
+            "live_settings": live_settings,
+            "error": error,
+            "refreshed_at": time.time()
+        })
+
+def bot_container_refresher():
+    """Background thread that refreshes the container cache every DOCKER_CACHE_TTL seconds or when poked."""
+    while True:
+        bot_container_refresh_requested.wait(DOCKER_CACHE_TTL)
+        bot_container_refresh_requested.clear()
+        refresh_bot_container_cache()
+
+def bot_container_event_listener():
+    """Background thread that requests a cache refresh whenever Docker reports an event for the bot container."""
+    while True:
+        try:
+            for _ in docker_client.events(decode=True, filters={"container": BOT_CONTAINER_NAME}):
+                bot_container_refresh_requested.set()
+        except Exception as e:
+            logger.warning(f"Docker event stream interrupted: {e}")
+        time.sleep(5)
+
+def get_bot_container_snapshot():
+    """Return a copy of the cached container state, inspecting synchronously only if nothing is cached yet."""
+    with bot_container_lock:
+        empty = bot_container_cache["refreshed_at"] is None
+    if empty:
+        refresh_bot_container_cache()
+    with bot_container_lock:
+        return dict(bot_container_cache)
+
+def get_bot_env_vars():
+    """Get environment variables from the bot container, served from the container cache."""
+    if docker_client is None:
+        return {
+            "DISCORD_TOKEN": "Not available - Docker client not initialized",
             "VOICE_LANGUAGE": "en",
             "COMMAND_PREFIX": "!",
             "ANNOUNCE_JOINS": "True",
@@ -98,14 +356,10 @@ def get_bot_env_vars():
             "WHITELIST_MODE": "False",
             "TZ": "UTC"
         }
-        
-        for key, default_value in defaults.items():
-            if key not in env_vars:
-                env_vars[key] = default_value
-        
-        return env_vars
-    except Exception as e:
-        logger.error(f"Error getting environment variables: {e}")
+    
+    snapshot = get_bot_container_snapshot()
+    if snapshot["env"] is None:
+        logger.error(f"Error getting environment variables: {snapshot['error']}")
         return {
             "DISCORD_TOKEN": "Error retrieving token",
             "VOICE_LANGUAGE": "en",
@@ -115,6 +369,32 @@ def get_bot_env_vars():
             "WHITELIST_MODE": "False",
             "TZ": "UTC"
         }
+    
+    env_vars = {key: value for key, value in snapshot["env"].items()
+                if key in ['DISCORD_TOKEN', 'VOICE_LANGUAGE', 'COMMAND_PREFIX', 
+                           'ANNOUNCE_JOINS', 'ANNOUNCE_LEAVES', 'WHITELIST_MODE', 'TZ']}
+    
+    # Fill in missing variables with defaults
+    defaults = {
+        "VOICE_LANGUAGE": "en",
+        "COMMAND_PREFIX": "!",
+        "ANNOUNCE_JOINS": "True",
+        "ANNOUNCE_LEAVES": "True",
+        "WHITELIST_MODE": "False",
+        "TZ": "UTC"
+    }
+    
+    for key, default_value in defaults.items():
+        if key not in env_vars:
+            env_vars[key] = default_value
+    
+    # Settings changed live take precedence over the container environment
+    if snapshot["live_settings"]:
+        for key in LIVE_SETTINGS:
+            if key in snapshot["live_settings"]:
+                env_vars[key] = str(snapshot["live_settings"][key])
+    
+    return env_vars
 
 def update_bot_env_vars(env_vars):
     """Update environment variables in the bot container."""
@@ -133,36 +413,59 @@ def update_bot_env_vars(env_vars):
         # Get the current container configuration
         config = container.attrs
         
-        # Create environment list for the new container
-        env_list = []
-        for key, value in env_vars.items():
-            env_list.append(f"{key}={value}")
+        # Merge the new values into the existing environment so settings the
+        # web interface does not manage (such as ADMIN_API_TOKEN) are kept
+        env = dict(item.split('=', 1) for item in config['Config'].get('Env') or [] if '=' in item)
+        env.update({key: str(value) for key, value in env_vars.items()})
+        env_list = [f"{key}={value}" for key, value in env.items()]
+        
+        # Networks the container is attached to, with their aliases minus the
+        # old container ID, so names like the compose service keep resolving
+        networks = {}
+        for name, settings in (config['NetworkSettings'].get('Networks') or {}).items():
+            aliases = [alias for alias in settings.get('Aliases') or [] if not container.id.startswith(alias)]
+            networks[name] = docker_client.api.create_endpoint_config(aliases=aliases or None)
         
         # Remove the container but keep the volumes
         container.remove()
         
-        # Create a new container with the same configuration but updated environment variables
-        image = config['Config']['Image']
-        volumes = {m['Source']: {'bind': m['Destination'], 'mode': m['Mode']} 
-                  for m in config['Mounts']}
-        restart_policy = config['HostConfig']['RestartPolicy']['Name']
-        
-        new_container = docker_client.containers.create(
-            image=image,
+        # Create a new container with the same configuration (mounts, ports,
+        # restart policy, labels and networks) but the updated environment.
+        # Only one network can be given at creation, which must be the network
+        # mode's; the rest are connected after.
+        network_mode = config['HostConfig'].get('NetworkMode')
+        network_names = sorted(networks, key=lambda name: name != network_mode)
+        networking_config = None
+        if network_names:
+            networking_config = docker_client.api.create_networking_config({network_names[0]: networks[network_names[0]]})
+        created = docker_client.api.create_container(
+            image=config['Config']['Image'],
             name=BOT_CONTAINER_NAME,
             environment=env_list,
-            volumes=volumes,
-            restart_policy={"Name": restart_policy}
+            labels=config['Config'].get('Labels'),
+            host_config=config['HostConfig'],
+            networking_config=networking_config
         )
+        for name in network_names[1:]:
+            docker_client.api.connect_container_to_network(created['Id'], name, aliases=networks[name].get('Aliases'))
+        new_container = docker_client.containers.get(created['Id'])
         
         # Start the new container
         new_container.start()
         logger.info(f"Container {BOT_CONTAINER_NAME} restarted with updated environment variables")
+        refresh_bot_container_cache()
         return True
     except Exception as e:
         logger.error(f"Error updating environment variables: {e}")
         return False
 
+# Create the state database and import the legacy JSON files on first run
+try:
+    with app.app_context():
+        import_legacy_json(get_db())
+except Exception as e:
+    logger.error(f"Error initializing state database: {e}")
+
 def restart_bot_container():
     """Restart the bot container."""
     if docker_client is None:
@@ -173,11 +476,17 @@ def restart_bot_container():
         container = docker_client.containers.get(BOT_CONTAINER_NAME)
         container.restart()
         logger.info(f"Container {BOT_CONTAINER_NAME} restarted")
+        refresh_bot_container_cache()
         return True
     except Exception as e:
         logger.error(f"Error restarting container: {e}")
         return False
 
+# Start the container cache refreshers
+if docker_client is not None:
+    threading.Thread(target=bot_container_refresher, name='docker-refresher', daemon=True).start()
+    threading.Thread(target=bot_container_event_listener, name='docker-events', daemon=True).start()
+
 # Routes
 @app.route('/')
 def home():
@@ -201,11 +510,16 @@ def environment_variables():
             else:
                 new_env[key] = request.form.get(key, current_env.get(key, ''))
         
-        # Update container environment variables
-        if update_bot_env_vars(new_env):
-            flash('Environment variables updated successfully!', 'success')
-        else:
+        # Apply live where possible, otherwise recreate the container
+        success, how = apply_bot_settings(new_env, current_env)
+        if not success:
             flash('Failed to update environment variables.', 'danger')
+        elif how == 'live':
+            flash('Settings applied to the running bot.', 'success')
+        elif how == 'unchanged':
+            flash('No changes to apply.', 'info')
+        else:
+            flash('Environment variables updated successfully!', 'success')
         
         return redirect(url_for('environment_variables'))
     
@@ -216,62 +530,62 @@ def environment_variables():
 @app.route('/custom_announcements', methods=['GET'])
 def custom_announcements():
     """Page to view and manage custom announcements."""
-    announcements = load_json_file(CUSTOM_ANNOUNCEMENTS_FILE, {"users": {}})
+    announcements, _ = load_custom_announcements()
     return render_template('custom_announcements.html', announcements=announcements)
 
 @app.route('/api/custom_announcements', methods=['GET'])
 def get_custom_announcements():
     """API endpoint to get custom announcements."""
-    announcements = load_json_file(CUSTOM_ANNOUNCEMENTS_FILE, {"users": {}})
-    return jsonify(announcements)
+    announcements, etag = load_custom_announcements()
+    return json_response_with_etag(announcements, etag)
 
 @app.route('/api/custom_announcements/<user_id>', methods=['POST'])
 def update_custom_announcement(user_id):
     """API endpoint to update a user's custom announcements."""
-    announcements = load_json_file(CUSTOM_ANNOUNCEMENTS_FILE, {"users": {}})
-    
     data = request.json
     display_name = data.get('display_name', 'Unknown User')
     join_message = data.get('join_message')
     leave_message = data.get('leave_message')
     
-    if user_id not in announcements["users"]:
-        announcements["users"][user_id] = {"display_name": display_name}
-    
-    if join_message is not None:
-        announcements["users"][user_id]["join_message"] = join_message
-    
-    if leave_message is not None:
-        announcements["users"][user_id]["leave_message"] = leave_message
-    
-    if save_json_file(CUSTOM_ANNOUNCEMENTS_FILE, announcements):
+    try:
+        db = get_db()
+        with db:
+            # Only overwrite the messages that were provided
+            db.execute(
+                """INSERT INTO custom_announcements VALUES (?, ?, ?, ?, ?)
+                   ON CONFLICT(user_id) DO UPDATE SET
+                       join_message = COALESCE(excluded.join_message, join_message),
+                       leave_message = COALESCE(excluded.leave_message, leave_message),
+                       updated_at = excluded.updated_at""",
+                (user_id, display_name, join_message, leave_message, time.time())
+            )
+        invalidate_read_cache('custom_announcements')
         return jsonify({"status": "success"})
-    else:
+    except Exception as e:
+        logger.error(f"Error saving custom announcement for {user_id}: {e}")
         return jsonify({"status": "error", "message": "Failed to save custom announcements"}), 500
 
 @app.route('/api/custom_announcements/<user_id>', methods=['DELETE'])
 def delete_custom_announcement(user_id):
     """API endpoint to delete a user's custom announcements."""
-    announcements = load_json_file(CUSTOM_ANNOUNCEMENTS_FILE, {"users": {}})
+    try:
+        db = get_db()
+        with db:
+            deleted = db.execute("DELETE FROM custom_announcements WHERE user_id = ?", (user_id,)).rowcount
+        invalidate_read_cache('custom_announcements')
+    except Exception as e:
+        logger.error(f"Error deleting custom announcement for {user_id}: {e}")
+        return jsonify({"status": "error", "message": "Failed to save custom announcements"}), 500
     
-    if user_id in announcements["users"]:
-        del announcements["users"][user_id]
-        
-        if save_json_file(CUSTOM_ANNOUNCEMENTS_FILE, announcements):
-            return jsonify({"status": "success"})
-        else:
-            return jsonify({"status": "error", "message": "Failed to save custom announcements"}), 500
+    if deleted:
+        return jsonify({"status": "success"})
     else:
         return jsonify({"status": "error", "message": "User not found"}), 404
 
 @app.route('/whitelist', methods=['GET'])
 def whitelist():
     """Page to view and manage whitelist."""
-    whitelist_data = load_json_file(WHITELIST_FILE, {"users": []})
-    
-    # Ensure whitelist data is properly formatted
-    if not isinstance(whitelist_data, dict) or "users" not in whitelist_data:
-        whitelist_data = {"users": []}
+    whitelist_data, _ = load_whitelist()
     
     # Get environment variables to check if whitelist mode is enabled
     env_vars = get_bot_env_vars()
@@ -282,48 +596,40 @@ def whitelist():
 @app.route('/api/whitelist', methods=['GET'])
 def get_whitelist():
     """API endpoint to get the whitelist."""
-    whitelist_data = load_json_file(WHITELIST_FILE, {"users": []})
-    return jsonify(whitelist_data)
+    whitelist_data, etag = load_whitelist()
+    return json_response_with_etag(whitelist_data, etag)
 
 @app.route('/api/whitelist/<user_id>', methods=['POST'])
 def add_to_whitelist(user_id):
     """API endpoint to add a user to the whitelist."""
-    whitelist_data = load_json_file(WHITELIST_FILE, {"users": []})
-    
-    # Ensure proper format
-    if not isinstance(whitelist_data, dict):
-        whitelist_data = {"users": []}
-    if "users" not in whitelist_data:
-        whitelist_data["users"] = []
+    try:
+        db = get_db()
+        with db:
+            added = db.execute("INSERT OR IGNORE INTO whitelist VALUES (?, ?)", (user_id, time.time())).rowcount
+        invalidate_read_cache('whitelist')
+    except Exception as e:
+        logger.error(f"Error adding {user_id} to whitelist: {e}")
+        return jsonify({"status": "error", "message": "Failed to save whitelist"}), 500
     
-    # Add user if not already in whitelist
-    if user_id not in whitelist_data["users"]:
-        whitelist_data["users"].append(user_id)
-        
-        if save_json_file(WHITELIST_FILE, whitelist_data):
-            return jsonify({"status": "success"})
-        else:
-            return jsonify({"status": "error", "message": "Failed to save whitelist"}), 500
+    if added:
+        return jsonify({"status": "success"})
     else:
         return jsonify({"status": "info", "message": "User already in whitelist"})
 
 @app.route('/api/whitelist/<user_id>', methods=['DELETE'])
 def remove_from_whitelist(user_id):
     """API endpoint to remove a user from the whitelist."""
-    whitelist_data = load_json_file(WHITELIST_FILE, {"users": []})
-    
-    # Ensure proper format
-    if not isinstance(whitelist_data, dict) or "users" not in whitelist_data:
-        return jsonify({"status": "error", "message": "Invalid whitelist format"}), 500
+    try:
+        db = get_db()
+        with db:
+            removed = db.execute("DELETE FROM whitelist WHERE user_id = ?", (user_id,)).rowcount
+        invalidate_read_cache('whitelist')
+    except Exception as e:
+        logger.error(f"Error removing {user_id} from whitelist: {e}")
+        return jsonify({"status": "error", "message": "Failed to save whitelist"}), 500
     
-    # Remove user if in whitelist
-    if user_id in whitelist_data["users"]:
-        whitelist_data["users"].remove(user_id)
-        
-        if save_json_file(WHITELIST_FILE, whitelist_data):
-            return jsonify({"status": "success"})
-        else:
-            return jsonify({"status": "error", "message": "Failed to save whitelist"}), 500
+    if removed:
+        return jsonify({"status": "success"})
     else:
         return jsonify({"status": "info", "message": "User not in whitelist"})
 
@@ -335,13 +641,29 @@ def toggle_whitelist_mode():
     
     # Toggle the mode
     new_mode = "False" if current_mode else "True"
-    env_vars["WHITELIST_MODE"] = new_mode
+    new_env = dict(env_vars, WHITELIST_MODE=new_mode)
     
-    if update_bot_env_vars(env_vars):
+    success, _ = apply_bot_settings(new_env, env_vars)
+    if success:
         return jsonify({"status": "success", "whitelist_mode": new_mode})
     else:
         return jsonify({"status": "error", "message": "Failed to update whitelist mode"}), 500
 
+@app.route('/api/bot_status', methods=['GET'])
+def bot_status():
+    """API endpoint exposing the cached bot container status and when it was last refreshed."""
+    if docker_client is None:
+        return jsonify({"status": "error", "message": "Docker client not initialized"}), 503
+    
+    snapshot = get_bot_container_snapshot()
+    return jsonify({
+        "container_status": snapshot["status"],
+        "refreshed_at": snapshot["refreshed_at"],
+        "cache_age_seconds": round(time.time() - snapshot["refreshed_at"], 1),
+        "live_settings_available": snapshot["live_settings"] is not None,
+        "error": snapshot["error"]
+    })
+
 @app.route('/restart', methods=['POST'])
 def restart_bot():
     """Restart the bot container."""